@@ -1,147 +1,332 @@
 import os
+import sys
 import json
 import sqlite3
 import zipfile
 import uuid  # === 引入 UUID 库 ===
+import threading
+import queue
+import time
+import signal
+import socket
+import tempfile
+import shutil
+import hashlib
+import fcntl
+from contextlib import contextmanager
+import hmac
+import marshal
+import cProfile
+import pstats
 from io import BytesIO
+from collections import deque
 from datetime import datetime, timedelta
 from itertools import groupby
 from operator import attrgetter
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, Response, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, send_from_directory, Response, jsonify, g, abort, has_app_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event, create_engine
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.exc import OperationalError
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from docx import Document
 from docx.shared import Inches
-from PIL import Image
+from PIL import Image, ImageOps
 import base64
+import gzip
+
+# 可选依赖：装了就启用紧凑二进制格式 / zstd 压缩 / 快速 JSON 编码，没装就回退到 JSON / gzip / 标准库
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 CORS(app)
 # 注意：SECRET_KEY 改为新的以区分版本
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default_key_for_dev') 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////data/todo.db'
-app.config['UPLOAD_FOLDER'] = '/data/uploads'
+# 数据目录可通过 DATA_DIR 覆盖 (默认 /data，便于本地调试与基准测试)
+app.config['DATA_DIR'] = os.environ.get('DATA_DIR', '/data')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.config['DATA_DIR'], 'todo.db')
+app.config['UPLOAD_FOLDER'] = os.path.join(app.config['DATA_DIR'], 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024 
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
+# Waitress 工作线程数，以及各通道 (lane) 的并发上限/排队上限/排队超时(秒)
+# 格式示例：LANE_LIMITS="image=2:2:5,export=1:1:10"  (并发:排队:超时)
+app.config['WAITRESS_THREADS'] = int(os.environ.get('WAITRESS_THREADS', 8))
+app.config['LANE_LIMITS'] = os.environ.get('LANE_LIMITS', 'image=2:2:5,export=1:1:10')
+app.config['LANE_RETRY_AFTER'] = int(os.environ.get('LANE_RETRY_AFTER', 5))
+# 响应压缩：小于该字节数的响应不压缩
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+# 多进程部署：WORKERS > 1 时由主进程预先绑定端口，再 fork 出多个 waitress 进程共享 /data
+app.config['PORT'] = int(os.environ.get('PORT', 5000))
+app.config['WORKERS'] = int(os.environ.get('WORKERS', 1))
+# SQLite 遇到写锁时最多等待的秒数
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 15))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT']}}
+# 分块续传：单块最大字节数、单个文件最大字节数、未完成会话的保留时间(小时)
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+app.config['UPLOAD_MAX_SIZE'] = int(os.environ.get('UPLOAD_MAX_SIZE', app.config['MAX_CONTENT_LENGTH']))
+app.config['UPLOAD_SESSION_TTL_HOURS'] = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 48))
+app.config['UPLOAD_PARTIAL_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.partial')
+# 在线备份：目标目录 (建议挂载到另一块盘)、自动备份间隔(小时，0 为关闭)、
+# 数据库保留份数，以及备份 API 每步复制的页数和步间休眠(秒)
+app.config['BACKUP_DIR'] = os.environ.get('BACKUP_DIR', os.path.join(app.config['DATA_DIR'], 'backups'))
+app.config['BACKUP_INTERVAL_HOURS'] = float(os.environ.get('BACKUP_INTERVAL_HOURS', 0))
+app.config['BACKUP_KEEP'] = int(os.environ.get('BACKUP_KEEP', 7))
+app.config['BACKUP_PAGES_PER_STEP'] = int(os.environ.get('BACKUP_PAGES_PER_STEP', 256))
+app.config['BACKUP_STEP_SLEEP'] = float(os.environ.get('BACKUP_STEP_SLEEP', 0.01))
+# 冷库：归档超过多少天的任务连同笔记移入 archive.db (0 为关闭)，以及后台搬迁间隔(小时)
+app.config['ARCHIVE_DB_PATH'] = os.path.join(app.config['DATA_DIR'], 'archive.db')
+app.config['ARCHIVE_COLD_AFTER_DAYS'] = float(os.environ.get('ARCHIVE_COLD_AFTER_DAYS', 30))
+app.config['ARCHIVE_SWEEP_INTERVAL_HOURS'] = float(os.environ.get('ARCHIVE_SWEEP_INTERVAL_HOURS', 24))
+# 按用户分库：共享库只保留账号数据，每个用户的任务/笔记在 users/<id>/ 下单独的 SQLite 文件
+# 空闲超过 PARTITION_IDLE_SECONDS 的连接池会被释放，同时打开的分库最多 PARTITION_MAX_ENGINES 个
+app.config['PARTITION_BY_USER'] = os.environ.get('PARTITION_BY_USER', '').lower() in ('1', 'true', 'yes')
+app.config['PARTITION_DIR'] = os.path.join(app.config['DATA_DIR'], 'users')
+app.config['PARTITION_IDLE_SECONDS'] = float(os.environ.get('PARTITION_IDLE_SECONDS', 600))
+app.config['PARTITION_MAX_ENGINES'] = int(os.environ.get('PARTITION_MAX_ENGINES', 32))
+# 组提交：写请求交给单个写线程，窗口内 (毫秒) 到达的写操作合并为一个事务提交
+app.config['GROUP_COMMIT'] = os.environ.get('GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+app.config['GROUP_COMMIT_WINDOW_MS'] = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 3))
+app.config['GROUP_COMMIT_MAX_BATCH'] = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+app.config['GROUP_COMMIT_TIMEOUT'] = float(os.environ.get('GROUP_COMMIT_TIMEOUT', 30))
+# 按需性能剖析：为空时完全不注册钩子
+app.config['PROFILE_SECRET'] = os.environ.get('PROFILE_SECRET', '')
+app.config['PROFILE_DIR'] = os.path.join(app.config['DATA_DIR'], 'profiles')
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 50))
+app.config['PROFILE_TOP'] = 15
+# Word 导出缓存目录与容量上限 (MB)
+app.config['DOCX_CACHE_DIR'] = os.path.join(app.config['DATA_DIR'], 'cache', 'docx')
+app.config['DOCX_CACHE_MAX_MB'] = float(os.environ.get('DOCX_CACHE_MAX_MB', 512))
+# 笔记分页：详情页每页条数，以及接口允许的最大每页条数
+app.config['NOTES_PAGE_SIZE'] = int(os.environ.get('NOTES_PAGE_SIZE', 20))
+app.config['NOTES_PAGE_MAX'] = 100
+# 数据库迁移每批处理的行数
+app.config['MIGRATION_CHUNK_SIZE'] = int(os.environ.get('MIGRATION_CHUNK_SIZE', 500))
+# 图片引擎：单张图片像素上限 (防解压炸弹)，以及上传时生成的派生图 (后缀, 最大尺寸, JPEG 质量)
+app.config['IMAGE_MAX_PIXELS'] = int(os.environ.get('IMAGE_MAX_PIXELS', 100_000_000))
+app.config['IMAGE_DERIVATIVES'] = [('_thumb.jpg', (300, 300), 70)]
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-db = SQLAlchemy(app)
+os.makedirs(app.config['UPLOAD_PARTIAL_FOLDER'], exist_ok=True)
+
+class PartitionedSession(FlaskSession):
+    """分库模式下，task / note (含冷库) 上的语句路由到当前用户自己的数据库"""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and app.config['PARTITION_BY_USER'] and targets_partition(mapper, clause):
+            user_id = current_partition()
+            if user_id is not None:
+                return PARTITIONS.engine(user_id)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': PartitionedSession})
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+def sqlite_pragmas(archive_path):
+    """生成 connect 监听器：设置 PRAGMA，并把 archive_path 挂载为 schema archive"""
+    def set_sqlite_pragmas(dbapi_conn, connection_record):
+        # WAL 模式下读写互不阻塞，多个进程/线程写入时按 busy_timeout 排队等锁
+        cursor = dbapi_conn.cursor()
+        # 冷库 archive.db 挂载到每个连接上，ArchivedTask / ArchivedNote 通过 schema "archive" 访问
+        cursor.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        cursor.execute("PRAGMA archive.journal_mode=WAL")
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'] * 1000)}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+    return set_sqlite_pragmas
+
+with app.app_context():
+    event.listen(db.engine, 'connect', sqlite_pragmas(app.config['ARCHIVE_DB_PATH']))
+
 
 # ==========================================
-# 核心迁移函数：处理 INTEGER ID 到 UUID ID 的转换
+# 数据库版本迁移：PRAGMA user_version 记录当前结构版本
 # ==========================================
+# 每个迁移是 MIGRATIONS 里的一项 (版本号, 名称, 函数, 范围)，按版本号顺序执行，
+# 每完成一个就把 user_version 写成该版本号。迁移函数需要自己保证：
+#   - 大表按 MIGRATION_CHUNK_SIZE 分批处理，每批一个事务，内存占用有上限
+#   - 进度写在 _migration_state 表里，进程崩溃后重启可以接着跑
+# 每个 SQLite 文件 (共享库 todo.db、冷库 archive.db、分库 users/<id>/ 下的两个
+# 文件) 各自用 user_version 记录版本，由 migrate_database 分别迁移。范围为
+# 'all' 的迁移在所有文件上执行 (冷库与分库里的表也叫 task / note)；'shared' 的
+# 只在共享库执行，其它文件跳过但版本号照样前进。
+# 文件的 user_version 已是最新时只读一次 PRAGMA 就返回。
 
 def get_db_column_info(cursor, table_name):
     """获取表的所有列信息"""
     cursor.execute(f"PRAGMA table_info({table_name})")
     return {info[1]: info[2] for info in cursor.fetchall()} # {column_name: column_type}
 
-def migrate_to_uuid_if_needed(app_context):
+def get_db_tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+def get_migration_state(conn, key, default=None):
+    conn.execute("CREATE TABLE IF NOT EXISTS _migration_state (key TEXT PRIMARY KEY, value TEXT)")
+    row = conn.execute("SELECT value FROM _migration_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_migration_state(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO _migration_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+def create_model_tables(conn, *models):
+    """在迁移自己的连接/事务里建表，保证与数据搬迁在同一个事务中"""
+    from sqlalchemy.dialects import sqlite as sqlite_dialect
+    from sqlalchemy.schema import CreateTable, CreateIndex
+    dialect = sqlite_dialect.dialect()
+    for model in models:
+        table = model.__table__
+        conn.execute(str(CreateTable(table).compile(dialect=dialect)))
+        for index in table.indexes:
+            conn.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+def migrate_v1_uuid_primary_keys(conn):
     """
-    检查 Task 表的主键类型，如果是 INTEGER，则执行复杂迁移。
+    v1: Task / Note 主键从 INTEGER 改为 UUID 字符串。
+    旧表先改名为 _task_old / _note_old，再分批搬到新表，旧 ID -> UUID 的映射存在 _uuid_map。
     """
-    db_path = app_context.app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
-    if not os.path.exists(db_path):
-        print("数据库文件不存在，将直接创建新表。")
-        return
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    chunk_size = app.config['MIGRATION_CHUNK_SIZE']
+    tables = get_db_tables(conn)
 
-    try:
-        task_cols = get_db_column_info(cursor, 'task')
-        
+    if '_task_old' not in tables:
+        if 'task' not in tables:
+            return
         # 1. 检测是否需要迁移：如果 'id' 字段类型是 'INTEGER' 或 'INT'
-        if task_cols.get('id', '').upper() not in ['STRING', 'VARCHAR', 'TEXT', 'VARCHAR(36)']:
-            print("=== 🚨 检测到旧 INTEGER ID 数据库，开始 UUID 迁移... ===")
-            
-            # --- 阶段 1: 准备数据和映射 ---
-            old_task_id_map = {} # 旧任务 ID (INT) -> 新任务 ID (UUID)
-            
-            # 备份旧任务数据
-            cursor.execute("SELECT id, title, category, priority, content, start_date, due_date, created_at, is_recurring, recurrence_days, completed, completed_at, is_archived, archived_at, user_id FROM task")
-            old_tasks = cursor.fetchall()
-            
-            # 备份旧笔记数据
-            cursor.execute("SELECT id, content, images, created_at, task_id FROM note")
-            old_notes = cursor.fetchall()
-
-            # --- 阶段 2: 重命名旧表并创建新表 (清空旧结构) ---
-            
-            # 1. 重命名旧表
-            cursor.execute("ALTER TABLE task RENAME TO _task_old")
-            cursor.execute("ALTER TABLE note RENAME TO _note_old")
-            conn.commit()
-            
-            # 2. 创建新表 (使用 UUID 架构)
-            # 因为我们在 app_context 中，可以直接调用 db.create_all()
-            with app_context:
-                db.create_all()
-            print("新的 UUID 数据库结构已创建。")
-
-            # --- 阶段 3: 导入任务数据 ---
-            new_tasks_to_insert = []
-            for t in old_tasks:
-                old_id = t[0]
-                new_uuid = str(uuid.uuid4())
-                old_task_id_map[old_id] = new_uuid
-                
-                # 重新组织数据以匹配新 Task 模型的字段顺序
-                # (id, title, category, priority, content, start_date, due_date, created_at, updated_at, is_recurring, recurrence_days, completed, completed_at, is_archived, archived_at, user_id)
-                new_tasks_to_insert.append((
-                    new_uuid, t[1], t[2], t[3], t[4], t[5], t[6], t[7], t[7], # created_at 和 updated_at 初始值相同
-                    t[8], t[9], t[10], t[11], t[12], t[13], t[14]
-                ))
-
-            # 批量插入新任务
-            task_insert_sql = "INSERT INTO task (id, title, category, priority, content, start_date, due_date, created_at, updated_at, is_recurring, recurrence_days, completed, completed_at, is_archived, archived_at, user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-            cursor.executemany(task_insert_sql, new_tasks_to_insert)
-            print(f"任务迁移完成：{len(new_tasks_to_insert)} 条记录。")
-
-            # --- 阶段 4: 导入笔记数据 ---
-            new_notes_to_insert = []
-            for n in old_notes:
-                old_note_id = n[0]
-                old_task_id = n[4]
-                
-                # 查找新的任务 UUID
-                new_task_uuid = old_task_id_map.get(old_task_id)
-                
-                if new_task_uuid:
-                    # 重新组织数据以匹配新 Note 模型的字段顺序
-                    # (id, content, images, created_at, updated_at, task_id)
-                    new_notes_to_insert.append((
-                        str(uuid.uuid4()), n[1], n[2], n[3], n[3], # created_at 和 updated_at 初始值相同
-                        new_task_uuid
-                    ))
-            
-            # 批量插入新笔记
-            note_insert_sql = "INSERT INTO note (id, content, images, created_at, updated_at, task_id) VALUES (?, ?, ?, ?, ?, ?)"
-            cursor.executemany(note_insert_sql, new_notes_to_insert)
-            print(f"笔记迁移完成：{len(new_notes_to_insert)} 条记录。")
-
-            # --- 阶段 5: 清理 ---
-            cursor.execute("DROP TABLE _task_old")
-            cursor.execute("DROP TABLE _note_old")
-            conn.commit()
-            print("旧表已删除，迁移成功。🎉")
-            
-        else:
+        if get_db_column_info(conn.cursor(), 'task').get('id', '').upper() in ['STRING', 'VARCHAR', 'TEXT', 'VARCHAR(36)']:
             print("数据库结构已是 UUID 格式，跳过迁移。")
-
+            return
+        print("=== 🚨 检测到旧 INTEGER ID 数据库，开始 UUID 迁移... ===")
+        # 2. 改名旧表 + 建新表 + 建映射表，放在同一个事务里
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE task RENAME TO _task_old")
+        conn.execute("ALTER TABLE note RENAME TO _note_old")
+        create_model_tables(conn, Task, Note)
+        conn.execute("CREATE TABLE _uuid_map (old_id INTEGER PRIMARY KEY, new_id TEXT NOT NULL)")
+        conn.execute("COMMIT")
+        print("新的 UUID 数据库结构已创建。")
+    else:
+        print("=== 检测到未完成的 UUID 迁移，从上次进度继续... ===")
+
+    # 3. 分批导入任务 (每批一个事务，映射与数据一起提交)
+    total = conn.execute("SELECT COUNT(*) FROM _task_old").fetchone()[0]
+    done = conn.execute("SELECT COUNT(*) FROM _uuid_map").fetchone()[0]
+    last_id = conn.execute("SELECT COALESCE(MAX(old_id), -1) FROM _uuid_map").fetchone()[0]
+    while True:
+        rows = conn.execute(
+            "SELECT id, title, category, priority, content, start_date, due_date, created_at, is_recurring, recurrence_days, completed, completed_at, is_archived, archived_at, user_id "
+            "FROM _task_old WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_size)).fetchall()
+        if not rows: break
+        conn.execute("BEGIN")
+        for t in rows:
+            new_uuid = str(uuid.uuid4())
+            # created_at 和 updated_at 初始值相同
+            conn.execute(
+                "INSERT INTO task (id, title, category, priority, content, start_date, due_date, created_at, updated_at, is_recurring, recurrence_days, completed, completed_at, is_archived, archived_at, user_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (new_uuid, t[1], t[2], t[3], t[4], t[5], t[6], t[7], t[7], t[8], t[9], t[10], t[11], t[12], t[13], t[14]))
+            conn.execute("INSERT INTO _uuid_map (old_id, new_id) VALUES (?, ?)", (t[0], new_uuid))
+        conn.execute("COMMIT")
+        last_id = rows[-1][0]
+        done += len(rows)
+        print(f"任务迁移进度：{done}/{total}")
+
+    # 4. 分批导入笔记 (找不到对应任务的孤儿笔记直接丢弃，与旧逻辑一致)
+    total = conn.execute("SELECT COUNT(*) FROM _note_old").fetchone()[0]
+    last_id = int(get_migration_state(conn, 'v1_last_note_id', -1))
+    done = conn.execute("SELECT COUNT(*) FROM _note_old WHERE id <= ?", (last_id,)).fetchone()[0]
+    while True:
+        rows = conn.execute(
+            "SELECT n.id, n.content, n.images, n.created_at, m.new_id FROM _note_old n "
+            "LEFT JOIN _uuid_map m ON m.old_id = n.task_id WHERE n.id > ? ORDER BY n.id LIMIT ?",
+            (last_id, chunk_size)).fetchall()
+        if not rows: break
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO note (id, content, images, created_at, updated_at, task_id) VALUES (?, ?, ?, ?, ?, ?)",
+            [(str(uuid.uuid4()), n[1], n[2], n[3], n[3], n[4]) for n in rows if n[4]])
+        last_id = rows[-1][0]
+        set_migration_state(conn, 'v1_last_note_id', last_id)
+        conn.execute("COMMIT")
+        done += len(rows)
+        print(f"笔记迁移进度：{done}/{total}")
+
+    # 5. 清理
+    conn.execute("BEGIN")
+    conn.execute("DROP TABLE _task_old")
+    conn.execute("DROP TABLE _note_old")
+    conn.execute("DROP TABLE _uuid_map")
+    conn.execute("DELETE FROM _migration_state WHERE key LIKE 'v1_%'")
+    conn.execute("COMMIT")
+    print("旧表已删除，迁移成功。🎉")
+
+def migrate_v2_upload_session(conn):
+    """v2: 新增分块续传会话表 upload_session"""
+    if 'upload_session' in get_db_tables(conn): return
+    conn.execute("BEGIN")
+    create_model_tables(conn, UploadSession)
+    conn.execute("COMMIT")
+
+def migrate_v3_note_task_created_index(conn):
+    """v3: note (task_id, created_at) 索引，用于笔记分页"""
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_note_task_created ON note (task_id, created_at)")
+
+MIGRATIONS = [
+    (1, 'uuid_primary_keys', migrate_v1_uuid_primary_keys, 'shared'),
+    (2, 'upload_session', migrate_v2_upload_session, 'shared'),
+    (3, 'note_task_created_index', migrate_v3_note_task_created_index, 'all'),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def run_migrations():
+    """启动时调用：迁移共享库 todo.db"""
+    migrate_database(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''), db.create_all, shared=True)
+
+def migrate_database(db_path, create_schema, shared=False):
+    """
+    按文件自己的 user_version 依次执行未完成的迁移。没有 task 表的新文件调用
+    create_schema() 直接建最新结构；迁移完成后也调用一次，补齐迁移之外新增的表
+    (如 user 表在极旧版本中不存在)。shared=False 时跳过范围为 'shared' 的迁移。
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=app.config['SQLITE_BUSY_TIMEOUT']) # 手动控制事务
+    label = os.path.relpath(db_path, app.config['DATA_DIR'])
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        if not get_db_tables(conn) & {'task', '_task_old'}:
+            if shared: print("数据库为空，直接创建最新结构。")
+            create_schema()
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            return
+        for target, name, migrate, scope in MIGRATIONS:
+            if target <= version: continue
+            if scope == 'all' or shared:
+                print(f"=== 执行数据库迁移 v{target} ({name}) : {label} ===")
+                started = time.monotonic()
+                migrate(conn)
+                print(f"=== 迁移 v{target} 完成，用时 {time.monotonic() - started:.1f}s ===")
+            conn.execute(f"PRAGMA user_version = {target}")
+        create_schema()
     except Exception as e:
-        print(f"🚨 数据库迁移失败 (数据未丢失，旧表已备份为 _task_old 和 _note_old): {e}")
-        # 确保回滚，防止数据状态不一致
-        conn.rollback()
-
+        print(f"🚨 数据库迁移失败 (已提交的批次不会丢失，重启后会从断点继续): {e}")
+        if conn.in_transaction: conn.execute("ROLLBACK")
+        raise
     finally:
         conn.close()
 
@@ -153,7 +338,8 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(150), nullable=False)
 
-class Task(db.Model):
+class TaskColumns:
+    # Task 与 ArchivedTask (冷库) 共用的字段与方法
     # === 核心变更：ID 改为 UUID 字符串 ===
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     
@@ -176,9 +362,6 @@ class Task(db.Model):
     is_archived = db.Column(db.Boolean, default=False)
     archived_at = db.Column(db.DateTime)
     
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    notes = db.relationship('Note', backref='task', lazy=True, cascade="all, delete-orphan")
-    
     def to_dict(self):
         return {
             'id': self.id, 
@@ -197,7 +380,8 @@ class Task(db.Model):
             'archived_at': self.archived_at.strftime('%Y-%m-%d %H:%M') if self.archived_at else None
         }
 
-class Note(db.Model):
+class NoteColumns:
+    # Note 与 ArchivedNote (冷库) 共用的字段与方法
     # === 核心变更：ID 改为 UUID 字符串 ===
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     
@@ -207,9 +391,6 @@ class Note(db.Model):
     # === 新增：更新时间戳 ===
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     
-    # === 核心变更：外键类型必须与 Task.id 一致 ===
-    task_id = db.Column(db.String(36), db.ForeignKey('task.id'), nullable=False)
-    
     def get_images(self):
         try: return json.loads(self.images) if self.images else []
         except: return []
@@ -222,6 +403,58 @@ class Note(db.Model):
             'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S') if self.updated_at else None
         }
 
+class Task(TaskColumns, db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    notes = db.relationship('Note', backref='task', lazy=True, cascade="all, delete-orphan")
+
+class Note(NoteColumns, db.Model):
+    # 详情页/接口按任务分页、按时间倒序读取笔记
+    __table_args__ = (db.Index('ix_note_task_created', 'task_id', 'created_at'),)
+    # === 核心变更：外键类型必须与 Task.id 一致 ===
+    task_id = db.Column(db.String(36), db.ForeignKey('task.id'), nullable=False)
+
+# --- 冷库模型：归档超过 ARCHIVE_COLD_AFTER_DAYS 天的任务及其笔记 ---
+# 存放在单独的 archive.db 中，每个连接都以 schema "archive" 挂载 (ATTACH)。
+# user_id 不加外键：SQLite 不支持跨库外键。
+
+class ArchivedTask(TaskColumns, db.Model):
+    __tablename__ = 'task'
+    __table_args__ = {'schema': 'archive'}
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    notes = db.relationship('ArchivedNote', backref='task', lazy=True, cascade="all, delete-orphan")
+
+class ArchivedNote(NoteColumns, db.Model):
+    __tablename__ = 'note'
+    __table_args__ = (db.Index('ix_note_task_created', 'task_id', 'created_at'), {'schema': 'archive'})
+    task_id = db.Column(db.String(36), db.ForeignKey('archive.task.id'), nullable=False)
+
+class UploadSession(db.Model):
+    # 分块续传会话：客户端按偏移量分块上传，完成后通过 upload_id 挂到笔记上
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)     # 客户端原始文件名
+    total_size = db.Column(db.Integer, nullable=False)
+    received = db.Column(db.Integer, default=0, nullable=False)
+    sha256 = db.Column(db.String(64))                         # 客户端声明的校验值 (可选)
+    stored_filename = db.Column(db.String(255))               # 完成后在 uploads 目录中的文件名
+    completed = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def partial_path(self):
+        return os.path.join(app.config['UPLOAD_PARTIAL_FOLDER'], f"{self.id}.part")
+
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'filename': self.filename,
+            'size': self.total_size,
+            'received': self.received,
+            'completed': self.completed,
+            'stored_filename': self.stored_filename,
+            'chunk_size': app.config['UPLOAD_CHUNK_SIZE']
+        }
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -231,15 +464,652 @@ def get_existing_categories(user_id):
     categories = [row[0] for row in query if row[0]]
     return sorted(categories)
 
-# --- 辅助函数 ---
+# ==========================================
+# 冷库：归档久了的任务移出热表
+# ==========================================
+# 热表 task/note 只保留活跃任务和最近归档的任务，列表、分类等热路径查询不再扫过
+# 大量历史数据。归档超过 ARCHIVE_COLD_AFTER_DAYS 天的任务连同笔记由 sweep_cold_archive
+# 分批搬进 archive.db。读取 (详情页、下载、归档视图) 直接读冷库；任何写操作前
+# 先用 get_hot_task / get_hot_note 把任务搬回热表，写完后它仍是归档状态，
+# 下次搬迁时会再回到冷库。搬回本身就是一次提交，所以路由要先用只读的
+# find_task / find_note 校验归属，再调用 get_hot_*。
+# 跨库事务在 WAL 模式下不是原子的：搬迁总是先 INSERT OR REPLACE 目标库再删源库，
+# 中途崩溃最多留下一份重复数据，查询时热表优先，下次搬迁会自动消除。
+# 搬迁 (含提交) 期间持有 archive_move_lock 的共享锁，备份开两个库的读快照时
+# 持有排它锁，这样备份里不会出现搬迁到一半、两边都缺的任务。
+
+# 排序方式 -> [(字段, 是否降序)]，SQL 排序与合并冷热数据后的 Python 排序共用
+TASK_SORTS = {
+    'created_desc': [('created_at', True)],
+    'created_asc': [('created_at', False)],
+    'completed_desc': [('completed_at', True)],
+    'due_date': [('due_date', False)],
+}
+DASHBOARD_DEFAULT_SORT = [('category', False), ('completed', False), ('due_date', False)]
+API_DEFAULT_SORT = [('created_at', True)]
+
+def task_order_by(model, sort_keys):
+    return [getattr(model, field).desc() if desc else getattr(model, field).asc() for field, desc in sort_keys]
+
+def sort_tasks(tasks, sort_keys):
+    """与 SQLite 一致：升序时 NULL 在前，降序时 NULL 在后"""
+    for field, desc in reversed(sort_keys):
+        tasks.sort(key=lambda t: (getattr(t, field) is not None, getattr(t, field)), reverse=desc)
+    return tasks
+
+def filter_tasks(query, model, q=None, category=None):
+    if q:
+        search = f"%{q}%"
+        query = query.filter((model.title.like(search)) | (model.content.like(search)) | (model.category.like(search)))
+    if category: query = query.filter(model.category == category)
+    return query
+
+def query_archived_tasks(user_id, q=None, category=None, sort_keys=DASHBOARD_DEFAULT_SORT):
+    """归档视图：合并热表中的归档任务与冷库任务"""
+    hot = filter_tasks(Task.query.filter_by(user_id=user_id).filter(Task.is_archived == True), Task, q, category).all()
+    hot_ids = {t.id for t in hot}
+    cold = [t for t in filter_tasks(ArchivedTask.query.filter_by(user_id=user_id), ArchivedTask, q, category).all()
+            if t.id not in hot_ids]
+    return sort_tasks(hot + cold, sort_keys)
+
+def find_task(task_id):
+    """只读查找：热表优先，其次冷库"""
+    if not task_id: return None
+    return Task.query.get(task_id) or ArchivedTask.query.get(task_id)
+
+def find_note(note_id):
+    if not note_id: return None
+    return Note.query.get(note_id) or ArchivedNote.query.get(note_id)
+
+def find_tasks(task_ids):
+    hot = Task.query.filter(Task.id.in_(task_ids)).all()
+    hot_ids = {t.id for t in hot}
+    cold = [t for t in ArchivedTask.query.filter(ArchivedTask.id.in_(task_ids)).all() if t.id not in hot_ids]
+    return hot + cold
+
+@contextmanager
+def archive_move_lock(exclusive=False):
+    """冷热搬迁与备份之间的文件锁，多进程之间也有效"""
+    with open(os.path.join(app.config['DATA_DIR'], '.archive-move.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+def move_tasks(task_ids, to_cold):
+    """在热表与冷库之间搬迁任务及其笔记 (调用方负责提交)"""
+    if not task_ids: return
+    src, dst = ('main', 'archive') if to_cold else ('archive', 'main')
+    task_cols = ', '.join(c.name for c in Task.__table__.columns)
+    note_cols = ', '.join(c.name for c in Note.__table__.columns)
+    params = {f'id{i}': task_id for i, task_id in enumerate(task_ids)}
+    ids = ', '.join(f':{key}' for key in params)
+    for sql in (
+        f"INSERT OR REPLACE INTO {dst}.task ({task_cols}) SELECT {task_cols} FROM {src}.task WHERE id IN ({ids})",
+        f"INSERT OR REPLACE INTO {dst}.note ({note_cols}) SELECT {note_cols} FROM {src}.note WHERE task_id IN ({ids})",
+        f"DELETE FROM {src}.note WHERE task_id IN ({ids})",
+        f"DELETE FROM {src}.task WHERE id IN ({ids})",
+    ):
+        db.session.execute(db.text(sql), params)
+    db.session.expire_all()
+
+def get_hot_task(task_id):
+    """写操作用：任务在冷库时先搬回热表，返回热表中的 Task (不存在返回 None)"""
+    if not task_id: return None
+    task = Task.query.get(task_id)
+    if task: return task
+    if ArchivedTask.query.get(task_id) is None: return None
+    with archive_move_lock():
+        move_tasks([task_id], to_cold=False)
+        db.session.commit()
+    return Task.query.get(task_id)
+
+def get_hot_note(note_id):
+    if not note_id: return None
+    note = Note.query.get(note_id)
+    if note: return note
+    cold_note = ArchivedNote.query.get(note_id)
+    if cold_note is None: return None
+    get_hot_task(cold_note.task_id)
+    return Note.query.get(note_id)
+
+def sweep_cold_archive():
+    """把归档超过 ARCHIVE_COLD_AFTER_DAYS 天的任务分批移入冷库，返回搬迁数量"""
+    days = app.config['ARCHIVE_COLD_AFTER_DAYS']
+    if days <= 0: return 0
+    cutoff = datetime.now() - timedelta(days=days)
+    moved = 0
+    for _ in each_partition():
+        while True:
+            ids = [row[0] for row in db.session.query(Task.id)
+                   .filter(Task.is_archived == True, Task.archived_at < cutoff)
+                   .limit(app.config['MIGRATION_CHUNK_SIZE']).all()]
+            if not ids: break
+            with archive_move_lock():
+                move_tasks(ids, to_cold=True)
+                db.session.commit()
+            moved += len(ids)
+    if moved: print(f"🧊 已将 {moved} 个归档任务移入冷库")
+    return moved
+
+ARCHIVE_TABLES = [ArchivedTask.__table__, ArchivedNote.__table__]
+
+def ensure_archive_schema():
+    """archive.db 可能是新文件，启动时建冷库表；已有文件按自己的 user_version 迁移"""
+    migrate_database(app.config['ARCHIVE_DB_PATH'], lambda: db.metadata.create_all(db.engine, tables=ARCHIVE_TABLES))
+
+# ==========================================
+# 按用户分库：每个用户一个 SQLite 文件，写锁互不影响
+# ==========================================
+# PARTITION_BY_USER 开启后，共享库 todo.db 只保留 user、upload_session 等账号数据，
+# 每个用户的 task / note 存在 users/<id>/todo.db，冷库在 users/<id>/archive.db。
+# 一个用户批量删除或搬迁时只锁自己的文件，其他用户的写入不用排队。
+#   - 路由：PartitionedSession.get_bind 按表名判断，task / note 上的语句 (含
+#     move_tasks 的原生 SQL) 发到当前用户的引擎。当前用户与路由实际认证的用户
+#     一致：/api/ 路由取 Basic Auth 的用户名 (密码仍由路由自己校验)，网页路由取
+#     登录态，get_request_user 取它返回的用户。写入的任务 user_id 与分库不符时
+#     before_flush 直接拒绝。
+#   - 后台任务 (冷库搬迁等) 用 use_partition / each_partition 显式指定用户。
+#   - 引擎按用户缓存，空闲超过 PARTITION_IDLE_SECONDS 或超出 PARTITION_MAX_ENGINES
+#     (按最近使用淘汰) 时释放连接池。
+#   - 已有数据在启动时由 split_into_partitions 拆分到各用户的库，可重复执行。
+
+PARTITIONED_TABLE_NAMES = {'task', 'note'}
+
+def targets_partition(mapper, clause):
+    if mapper is not None:
+        return db.inspect(mapper).local_table.name in PARTITIONED_TABLE_NAMES
+    # 没有 mapper 的原生 SQL 只有 move_tasks 在用，都是 task / note
+    return isinstance(clause, TextClause)
+
+def basic_auth_user_id():
+    auth = request.authorization
+    if auth and auth.username:
+        user = User.query.filter_by(username=auth.username).first()
+        if user: return user.id
+    return None
+
+def request_partition():
+    # /api/ 路由在函数内自己校验 Basic Auth，按它认证的用户选库，不看登录 Cookie；
+    # 网页路由用 current_user。get_request_user 会直接指定它返回的用户。
+    if request.path.startswith('/api/') and request.authorization:
+        return basic_auth_user_id()
+    if current_user.is_authenticated: return current_user.id
+    return basic_auth_user_id()
+
+def current_partition():
+    """当前请求/上下文对应的用户 id，每个请求只解析一次"""
+    if not has_app_context(): return None
+    if 'partition_user_id' not in g:
+        g.partition_user_id = request_partition() if has_request_context() else None
+    return g.partition_user_id
+
+@contextmanager
+def use_partition(user_id):
+    previous = g.get('partition_user_id')
+    g.partition_user_id = user_id
+    try:
+        yield
+    finally:
+        g.partition_user_id = previous
+
+@event.listens_for(PartitionedSession, 'before_flush')
+def check_partition_owner(session, flush_context, instances):
+    """兜底：任务的 user_id 与当前分库不一致时拒绝写入，避免数据落进别人的库"""
+    if not app.config['PARTITION_BY_USER']: return
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, (Task, ArchivedTask)) and obj.user_id != current_partition():
+            raise PermissionError(f"Task of user {obj.user_id} cannot be written to partition {current_partition()}")
+
+def partition_paths(user_id):
+    """(分库路径, 分库冷库路径)"""
+    folder = os.path.join(app.config['PARTITION_DIR'], str(int(user_id)))
+    return os.path.join(folder, 'todo.db'), os.path.join(folder, 'archive.db')
+
+def partition_user_ids():
+    folder = app.config['PARTITION_DIR']
+    if not os.path.isdir(folder): return []
+    return sorted(int(name) for name in os.listdir(folder) if name.isdigit())
+
+def each_partition():
+    """依次切换到每个用户的分库；未开启分库时只执行一次 (共享库)"""
+    if not app.config['PARTITION_BY_USER']:
+        yield None
+        return
+    for user_id in partition_user_ids():
+        with use_partition(user_id):
+            yield user_id
+
+def create_partition_engine(user_id):
+    db_path, archive_path = partition_paths(user_id)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    engine = create_engine('sqlite:///' + db_path, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    event.listen(engine, 'connect', sqlite_pragmas(archive_path))
+    if app.config['PROFILE_SECRET']:
+        event.listen(engine, 'before_cursor_execute', record_sql_start)
+        event.listen(engine, 'after_cursor_execute', record_sql_end)
+    # 新文件直接建最新结构；已有文件 (含冷库) 按各自的 user_version 补跑迁移
+    migrate_database(db_path, lambda: db.metadata.create_all(engine, tables=[Task.__table__, Note.__table__]))
+    migrate_database(archive_path, lambda: db.metadata.create_all(engine, tables=ARCHIVE_TABLES))
+    return engine
+
+def migrate_partitions():
+    """启动时迁移所有分库，免得第一次打开分库的请求去跑迁移"""
+    for user_id in partition_user_ids():
+        create_partition_engine(user_id).dispose()
+
+class PartitionPool:
+    """user_id -> 引擎，带空闲回收与 LRU 上限"""
+    def __init__(self):
+        self._engines = {}  # user_id -> [engine, 最近使用时间]
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.created = 0
+        self.evicted = 0
+
+    def engine(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._engines.get(user_id)
+            if entry is None:
+                entry = self._engines[user_id] = [create_partition_engine(user_id), now]
+                self.created += 1
+            entry[1] = now
+            if len(self._engines) > app.config['PARTITION_MAX_ENGINES'] or now - self._last_sweep > 60:
+                self._evict(now)
+            return entry[0]
+
+    def _evict(self, now):
+        self._last_sweep = now
+        by_age = sorted(self._engines.items(), key=lambda item: item[1][1])
+        excess = len(by_age) - app.config['PARTITION_MAX_ENGINES']
+        for i, (user_id, (engine, last_used)) in enumerate(by_age):
+            if i >= excess and now - last_used <= app.config['PARTITION_IDLE_SECONDS']: break
+            # 正在使用中的连接归还时随旧连接池一起关闭
+            engine.dispose()
+            del self._engines[user_id]
+            self.evicted += 1
+
+    def drop(self, user_id):
+        """注销账号时关闭引擎并删除该用户的分库文件"""
+        with self._lock:
+            entry = self._engines.pop(user_id, None)
+        if entry: entry[0].dispose()
+        shutil.rmtree(os.path.dirname(partition_paths(user_id)[0]), ignore_errors=True)
+
+    def dispose_all(self):
+        with self._lock:
+            for engine, _ in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+    def reset_after_fork(self):
+        """fork 出的子进程里调用：丢掉继承来的引擎但不关闭连接 (连接归父进程)"""
+        # fork 时父进程的线程可能正拿着锁，子进程里换一把新的
+        self._lock = threading.Lock()
+        for engine, _ in self._engines.values():
+            engine.dispose(close=False)
+        self._engines = {}
+
+    def snapshot(self):
+        with self._lock:
+            return {'open': len(self._engines), 'created': self.created, 'evicted': self.evicted}
+
+PARTITIONS = PartitionPool()
+
+def split_into_partitions():
+    """
+    把共享库 (含冷库) 中的任务与笔记按用户拆到各自的分库，返回搬迁的任务数。
+    每个用户先 INSERT OR IGNORE 复制并提交到分库，再从共享库删除，
+    中途崩溃重跑不会丢数据也不会重复。共享库里没有任务时直接返回。
+    """
+    db_path = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=app.config['SQLITE_BUSY_TIMEOUT'])
+    task_cols = ', '.join(c.name for c in Task.__table__.columns)
+    note_cols = ', '.join(c.name for c in Note.__table__.columns)
+    moved = 0
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (app.config['ARCHIVE_DB_PATH'],))
+        user_ids = [row[0] for row in conn.execute("SELECT user_id FROM main.task UNION SELECT user_id FROM archive.task")]
+        for user_id in user_ids:
+            PARTITIONS.engine(user_id)  # 确保分库结构已建好
+            conn.execute("ATTACH DATABASE ? AS part", (partition_paths(user_id)[0],))
+            conn.execute("ATTACH DATABASE ? AS part_archive", (partition_paths(user_id)[1],))
+            try:
+                pairs = (('main', 'part'), ('archive', 'part_archive'))
+                conn.execute("BEGIN IMMEDIATE")
+                count = 0
+                for src, dst in pairs:
+                    count += conn.execute(f"SELECT COUNT(*) FROM {src}.task WHERE user_id = ?", (user_id,)).fetchone()[0]
+                    conn.execute(f"INSERT OR IGNORE INTO {dst}.task ({task_cols}) SELECT {task_cols} FROM {src}.task WHERE user_id = ?", (user_id,))
+                    conn.execute(f"INSERT OR IGNORE INTO {dst}.note ({note_cols}) SELECT {note_cols} FROM {src}.note "
+                                 f"WHERE task_id IN (SELECT id FROM {src}.task WHERE user_id = ?)", (user_id,))
+                conn.execute("COMMIT")
+                conn.execute("BEGIN IMMEDIATE")
+                for src, _ in pairs:
+                    conn.execute(f"DELETE FROM {src}.note WHERE task_id IN (SELECT id FROM {src}.task WHERE user_id = ?)", (user_id,))
+                    conn.execute(f"DELETE FROM {src}.task WHERE user_id = ?", (user_id,))
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction: conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.execute("DETACH DATABASE part")
+                conn.execute("DETACH DATABASE part_archive")
+            moved += count
+            print(f"🗂️ 用户 {user_id} 的 {count} 个任务已拆分到独立数据库")
+    finally:
+        conn.close()
+    return moved
+
+# ==========================================
+# 组提交：多个请求的写操作合并成一个事务
+# ==========================================
+# 每个写请求各自 commit 时，每次都要单独拿一次写锁、做一次 fsync，多台手机
+# 同时回放离线队列时吞吐很快就上不去。开启 GROUP_COMMIT 后，写路由把写操作
+# 包成一个“单元” (不带参数的函数) 交给 commit_write：
+#   - 写线程取到第一个单元后再等 GROUP_COMMIT_WINDOW_MS 毫秒，把期间到达的
+#     单元 (最多 GROUP_COMMIT_MAX_BATCH 个) 放进同一个事务，只提交一次；
+#   - 每个单元执行后立即 flush，出错的单元单独报错，其余单元回滚后重跑再提交，
+#     所以单元内只能用 db.session 读写数据库、按 id 重新查询对象，不能自己
+#     commit，也不要做文件读写等副作用，返回值用普通类型 (id、布尔值等)；
+#   - 提交结果 (返回值或异常) 交回给各自的请求线程；GROUP_COMMIT_TIMEOUT 秒内
+#     写线程还没取走的单元直接丢弃并返回 503，保证没有写入，客户端可以放心重试；
+#     已经取走的单元继续等结果 (每批结束时都会交回，最长受 busy_timeout 限制)。
+# 未开启时 commit_write 直接在请求自己的 session 里执行单元并提交。
+
+class WriteTimeout(Exception):
+    """写线程在 GROUP_COMMIT_TIMEOUT 内没有取走单元，单元已丢弃、没有写入"""
+
+class WriteUnit:
+    __slots__ = ('fn', 'partition', 'enqueued', 'done', 'result', 'error', 'started', 'abandoned')
+
+    def __init__(self, fn, partition):
+        self.fn = fn
+        self.partition = partition
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.started = False  # 写线程已取走，之后一定会给出结果
+        self.abandoned = False  # 请求已超时返回，写线程取到时直接跳过
+
+class GroupCommitWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+        self._thread = None
+        self.batches = 0
+        self.units = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.max_batch = 0
+        self.latencies = deque(maxlen=1000)  # 最近单元从入队到提交完成的毫秒数
+
+    def submit(self, fn, partition=None):
+        unit = WriteUnit(fn, partition)
+        self._ensure_started().put(unit)
+        if not unit.done.wait(app.config['GROUP_COMMIT_TIMEOUT']):
+            with self._lock:
+                # 写线程已经开始执行的单元可能已经提交，不能让客户端以为没写入而重试
+                # (没带 id 的新建会重复)，只有还没取走的单元才丢弃并返回 503
+                if not unit.started:
+                    unit.abandoned = True
+                    self.timeouts += 1
+            if unit.abandoned: raise WriteTimeout()
+            unit.done.wait()
+        if unit.error is not None: raise unit.error
+        return unit.result
+
+    def _ensure_started(self):
+        # 多进程模式下 fork 出来的 worker 没有父进程的线程，按进程各起一个写线程；
+        # 写线程意外退出时也在这里重新拉起，队列里没处理的单元交给新线程
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), name='group-commit', daemon=True)
+                self._thread.start()
+            return self._queue
+
+    def _run(self, units):
+        window = app.config['GROUP_COMMIT_WINDOW_MS'] / 1000
+        max_batch = app.config['GROUP_COMMIT_MAX_BATCH']
+        with app.app_context():
+            while True:
+                batch = [units.get()]
+                try:
+                    deadline = time.monotonic() + window
+                    while len(batch) < max_batch:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0: break
+                        try:
+                            batch.append(units.get(timeout=remaining))
+                        except queue.Empty:
+                            break
+                    self._commit(batch)
+                except Exception as e:
+                    # 不能让写线程死掉，否则之后所有写请求都会卡到超时
+                    print(f"🚨 组提交写线程出错: {e}")
+                    with self._lock: self.crashes += 1
+                    for unit in batch:
+                        if not unit.done.is_set():
+                            unit.error = e
+                            unit.done.set()
+                finally:
+                    try:
+                        db.session.close()
+                    except Exception as e:
+                        print(f"🚨 组提交关闭 session 出错: {e}")
+
+    def _apply(self, units):
+        """依次执行并 flush，返回第一个出错的单元 (全部成功返回 None)"""
+        for unit in units:
+            try:
+                with use_partition(unit.partition):
+                    unit.result = unit.fn()
+                    db.session.flush()
+            except Exception as e:
+                unit.error = e
+                return unit
+        return None
+
+    def _commit(self, batch):
+        with self._lock:
+            # 请求已超时放弃的单元不再执行，其余的标记为已开始
+            batch = [unit for unit in batch if not unit.abandoned]
+            for unit in batch: unit.started = True
+        if not batch: return
+        pending = list(batch)
+        try:
+            while pending:
+                failed = self._apply(pending)
+                if failed is None: break
+                # 回滚会丢掉同批前面单元的修改，去掉出错的单元后整批重跑
+                db.session.rollback()
+                pending.remove(failed)
+                for unit in pending: unit.error = None
+            if pending: db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for unit in pending: unit.error = e
+        finally:
+            # 统计出错也要把结果交回去，否则请求线程会一直等到超时
+            try:
+                finished = time.perf_counter()
+                with self._lock:
+                    self.batches += 1
+                    self.units += len(batch)
+                    self.failed += sum(1 for unit in batch if unit.error is not None)
+                    self.max_batch = max(self.max_batch, len(batch))
+                    self.latencies.extend((finished - unit.enqueued) * 1000 for unit in batch)
+            finally:
+                for unit in batch: unit.done.set()
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            pick = lambda q: round(latencies[min(len(latencies) - 1, int(len(latencies) * q))], 3) if latencies else None
+            return {
+                'window_ms': app.config['GROUP_COMMIT_WINDOW_MS'],
+                'max_batch_size': app.config['GROUP_COMMIT_MAX_BATCH'],
+                'queued': self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+                'batches': self.batches,
+                'units': self.units,
+                'failed': self.failed,
+                'timeouts': self.timeouts,
+                'crashes': self.crashes,
+                'avg_batch': round(self.units / self.batches, 2) if self.batches else None,
+                'peak_batch': self.max_batch,
+                'latency_ms': {'p50': pick(0.5), 'p95': pick(0.95), 'max': round(latencies[-1], 3) if latencies else None}
+            }
+
+WRITER = GroupCommitWriter() if app.config['GROUP_COMMIT'] else None
+
+def commit_write(unit):
+    """执行写操作单元并提交，返回 unit() 的结果"""
+    if WRITER is None:
+        result = unit()
+        db.session.commit()
+        return result
+    # 请求自己的读事务会固定 WAL 快照，先结束它，之后的读取才能看到写线程的提交
+    db.session.rollback()
+    return WRITER.submit(unit, current_partition() if app.config['PARTITION_BY_USER'] else None)
+
+@app.errorhandler(WriteTimeout)
+def handle_write_timeout(e):
+    """写线程卡住或积压时让客户端稍后重试，而不是一直占着请求线程"""
+    response = jsonify({'error': 'Write queue busy, please retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['LANE_RETRY_AFTER'])
+    return response
+
+@app.route('/api/writes')
+def api_writes():
+    """组提交的批大小与延迟统计 (未开启时 group_commit 为 null)"""
+    if not get_request_user(): return jsonify({'error': 'Auth required'}), 401
+    return jsonify({'status': 'success', 'group_commit': WRITER.snapshot() if WRITER else None})
+
+# ==========================================
+# 文件写入：多进程/多线程安全
+# ==========================================
+# 所有写入 /data 的文件都先写到同目录的临时文件，再 os.replace 原子替换。
+# 其他进程要么看不到文件，要么看到完整的文件，不会读到写了一半的图片。
+
+def atomic_write(path, writer):
+    """writer(f) 负责把内容写进已打开的二进制文件对象 f"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer(f)
+        os.chmod(tmp_path, 0o644) # mkstemp 默认 0600，保持与普通上传文件一致
+        os.replace(tmp_path, path)
+    except Exception:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+def make_upload_filename(original):
+    """UUID 前缀的上传文件名，多进程同时上传也不会撞名"""
+    name = secure_filename(original or '')
+    if '.' not in name:
+        ext = secure_filename(os.path.splitext(original or '')[1].lstrip('.'))
+        name = f"image.{ext}" if ext else 'image'
+    return f"{uuid.uuid4().hex}_{name}"
+
+def save_upload(file):
+    """保存上传图片并生成缩略图，返回保存后的文件名"""
+    filename = make_upload_filename(file.filename)
+    save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    atomic_write(save_path, lambda f: shutil.copyfileobj(file.stream, f))
+    create_thumbnail(save_path)
+    return filename
+
+# ==========================================
+# 图片引擎：缩略图生成与动态缩放共用
+# ==========================================
+# - JPEG 用 draft() 在 DCT 域直接按 1/2、1/4、1/8 解码，不必先解出全尺寸
+# - 其余格式靠 resize 的 reducing_gap 先做整数倍 reduce 再精细缩放
+# - 只读一次 EXIF Orientation 并旋正，手机照片不再横躺
+# - 超过 IMAGE_MAX_PIXELS 的图片拒绝解码
+# - 多个尺寸共用一次解码，从大到小逐级缩放
+
+Image.MAX_IMAGE_PIXELS = app.config['IMAGE_MAX_PIXELS']
+EXIF_ORIENTATION = 0x0112
+
+def fit_size(size, box):
+    """按 box 等比缩小 (不放大)，box 的某一边为 None 时只按另一边约束"""
+    w, h = size
+    bw, bh = box
+    scale = min(bw / w if bw else 1, bh / h if bh else 1, 1)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+def decode_image(image_path, target=None):
+    """
+    解码图片并旋正。target 为最终需要的 (宽, 高)，用于 JPEG draft 缩小解码。
+    返回已加载的 Image，调用方负责 close。
+    """
+    img = Image.open(image_path)
+    try:
+        w, h = img.size
+        if w * h > app.config['IMAGE_MAX_PIXELS']:
+            raise Image.DecompressionBombError(f"图片像素过大: {w}x{h}")
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        if target and img.format == 'JPEG':
+            tw, th = target
+            # 旋转 90/270 度的照片，原始像素的宽高与显示相反
+            if orientation in (5, 6, 7, 8): tw, th = th, tw
+            img.draft(img.mode, (tw, th))
+        img.load()
+        if orientation != 1:
+            rotated = ImageOps.exif_transpose(img)
+            img.close()
+            img = rotated
+        return img
+    except Exception:
+        img.close()
+        raise
+
+def oriented_size(image_path):
+    """不解码像素，只读头部得到旋正后的尺寸"""
+    with Image.open(image_path) as img:
+        w, h = img.size
+        if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8): w, h = h, w
+        return w, h
+
+def derive_images(image_path, boxes):
+    """一次解码生成多个尺寸的 RGB 图，返回顺序与 boxes 一致"""
+    full_size = oriented_size(image_path)
+    targets = [fit_size(full_size, box) for box in boxes]
+    largest = max(targets, key=lambda s: s[0] * s[1])
+    results = [None] * len(boxes)
+    current = decode_image(image_path, largest)
+    try:
+        if current.mode not in ('RGB', 'L'):
+            converted = current.convert('RGB')
+            current.close()
+            current = converted
+        for i in sorted(range(len(targets)), key=lambda i: -targets[i][0] * targets[i][1]):
+            results[i] = current.resize(targets[i], Image.Resampling.LANCZOS, reducing_gap=3.0)
+            current.close()
+            current = results[i]
+        return results
+    except Exception:
+        current.close()
+        raise
+
 def create_thumbnail(image_path):
     try:
-        thumb_path = image_path.rsplit('.', 1)[0] + '_thumb.jpg'
-        if os.path.exists(thumb_path): return os.path.basename(thumb_path)
-        with Image.open(image_path) as img:
-            if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
-            img.thumbnail((300, 300))
-            img.save(thumb_path, "JPEG", quality=70)
+        base = image_path.rsplit('.', 1)[0]
+        thumb_path = base + '_thumb.jpg'
+        pending = [(base + suffix, box, quality) for suffix, box, quality in app.config['IMAGE_DERIVATIVES']
+                   if not os.path.exists(base + suffix)]
+        if not pending: return os.path.basename(thumb_path)
+        images = derive_images(image_path, [box for _, box, _ in pending])
+        for (path, _, quality), img in zip(pending, images):
+            atomic_write(path, lambda f: img.save(f, "JPEG", quality=quality))
         return os.path.basename(thumb_path)
     except Exception as e:
         print(f"缩略图生成失败: {e}")
@@ -253,27 +1123,37 @@ def image_to_base64(image_path):
             return f"data:image/jpeg;base64,{encoded_string}"
     except Exception as e: return None
 
+def build_images_info(images, binary=False):
+    """
+    组装笔记图片信息。binary=True 时缩略图以原始 JPEG 字节放在 'thumb' 字段
+    (给 MessagePack 用)，否则以 Base64 放在 'thumb_base64' 字段 (JSON)。
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    images_info = []
+    for img in images:
+        full_url = url_for('serve_image', filename=img, _external=True)
+        thumb_name = img.rsplit('.', 1)[0] + '_thumb.jpg'
+        thumb_path = os.path.join(upload_folder, thumb_name)
+        if not os.path.exists(thumb_path): create_thumbnail(os.path.join(upload_folder, img))
+        if binary:
+            try:
+                with open(thumb_path, 'rb') as f: thumb = f.read()
+            except OSError: thumb = None
+            images_info.append({'original_url': full_url, 'thumb': thumb, 'filename': img})
+        else:
+            images_info.append({'original_url': full_url, 'thumb_base64': image_to_base64(thumb_path), 'filename': img})
+    return images_info
+
 def get_grouped_tasks(user_id, filters):
-    query = Task.query.filter_by(user_id=user_id)
+    sort_keys = TASK_SORTS.get(filters.get('sort_by', 'default'), DASHBOARD_DEFAULT_SORT)
     if filters.get('show_archived') == 'true':
-        query = query.filter(Task.is_archived == True)
+        # 归档视图：热表中刚归档的 + 冷库中的
+        tasks = query_archived_tasks(user_id, filters.get('q'), filters.get('category'), sort_keys)
     else:
-        query = query.filter((Task.is_archived == False) | (Task.is_archived == None))
-    
-    if filters.get('q'):
-        search = f"%{filters['q']}%"
-        query = query.filter((Task.title.like(search)) | (Task.content.like(search)) | (Task.category.like(search)))
-    
-    if filters.get('category'): query = query.filter(Task.category == filters['category'])
-
-    sort_by = filters.get('sort_by', 'default')
-    if sort_by == 'created_desc': query = query.order_by(Task.created_at.desc())
-    elif sort_by == 'created_asc': query = query.order_by(Task.created_at.asc())
-    elif sort_by == 'completed_desc': query = query.order_by(Task.completed_at.desc())
-    elif sort_by == 'due_date': query = query.order_by(Task.due_date.asc())
-    else: query = query.order_by(Task.category, Task.completed, Task.due_date)
+        query = Task.query.filter_by(user_id=user_id).filter((Task.is_archived == False) | (Task.is_archived == None))
+        query = filter_tasks(query, Task, filters.get('q'), filters.get('category'))
+        tasks = query.order_by(*task_order_by(Task, sort_keys)).all()
 
-    tasks = query.all()
     grouped_data = {}
     for task in tasks:
         cat = task.category if task.category and task.category.strip() else '其他'
@@ -281,6 +1161,470 @@ def get_grouped_tasks(user_id, filters):
         grouped_data[cat].append(task)
     return grouped_data
 
+# ==========================================
+# 列表接口快速读路径：绕过 ORM，直接序列化列元组
+# ==========================================
+# ORM 路径每个任务要构造对象、跑 6 次 strftime、逐个懒加载笔记，
+# 每条笔记再 json.loads 一次。这里用 Core 只查 to_dict 需要的列，
+# 笔记按任务 id 批量一次查回。日期列按原始文本取出：SQLAlchemy 写入
+# SQLite 的格式固定为 "YYYY-MM-DD HH:MM:SS.ffffff"，to_dict 的两种
+# strftime 格式正好是它的前 16 / 19 个字符，切片即可。输出与 to_dict 完全一致。
+
+# (字段名, 日期截取长度)，顺序与 to_dict 一致
+TASK_ROW_FIELDS = [
+    ('id', None), ('title', None), ('category', None), ('priority', None), ('content', None),
+    ('start_date', 16), ('due_date', 16), ('created_at', 16), ('updated_at', 19),
+    ('recurrence_days', None), ('completed', None), ('completed_at', 16),
+    ('is_archived', None), ('archived_at', 16),
+]
+NOTE_ROW_FIELDS = [('id', None), ('content', None), ('images', None), ('created_at', 16), ('updated_at', 19)]
+
+class RowSerializer:
+    """按字段表预先算好要查的列和日期列的位置，把 Row 直接转成 to_dict 的结构"""
+    def __init__(self, model, fields, extra=()):
+        self.keys = [key for key, _ in fields]
+        self.columns = [db.type_coerce(getattr(model, key), db.String).label(key) if cut else getattr(model, key)
+                        for key, cut in fields] + [getattr(model, key) for key in extra]
+        self.dates = [(key, i, cut) for i, (key, cut) in enumerate(fields) if cut]
+
+    def __call__(self, row):
+        # extra 列在末尾，zip 按 keys 长度截断
+        item = dict(zip(self.keys, row))
+        for key, i, cut in self.dates:
+            value = row[i]
+            item[key] = value[:cut] if value else None
+        return item
+
+TASK_ROWS = {model: RowSerializer(model, TASK_ROW_FIELDS) for model in (Task, ArchivedTask)}
+NOTE_ROWS = {model: RowSerializer(model, NOTE_ROW_FIELDS, extra=('task_id',)) for model in (Note, ArchivedNote)}
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+def parse_images(raw):
+    """与 get_images 相同，空列表不走 JSON 解析"""
+    if not raw or raw == '[]': return []
+    try: return json_loads(raw)
+    except ValueError: return []
+
+def select_task_rows(model, user_id, q=None):
+    return filter_tasks(db.select(*TASK_ROWS[model].columns).where(model.user_id == user_id), model, q)
+
+def fetch_note_rows(model, task_ids):
+    """{task_id: [Row]}，每批 MIGRATION_CHUNK_SIZE 个任务一次 IN 查询"""
+    serializer = NOTE_ROWS[model]
+    notes = {}
+    task_ids = list(task_ids)
+    chunk = app.config['MIGRATION_CHUNK_SIZE']
+    for start in range(0, len(task_ids), chunk):
+        stmt = (db.select(*serializer.columns)
+                .where(model.task_id.in_(task_ids[start:start + chunk]))
+                .order_by(model.task_id, model.created_at))
+        for row in db.session.execute(stmt):
+            notes.setdefault(row.task_id, []).append(row)
+    return notes
+
+def list_task_dicts(user_id, show_archived=False, q=None, sort_keys=API_DEFAULT_SORT, binary=False):
+    """api_get_tasks 的数据：筛选排序与 ORM 路径一致，每个任务带 notes 与 images_info"""
+    if show_archived:
+        hot = db.session.execute(select_task_rows(Task, user_id, q).where(Task.is_archived == True)).all()
+        hot_ids = {row.id for row in hot}
+        cold = [row for row in db.session.execute(select_task_rows(ArchivedTask, user_id, q)).all() if row.id not in hot_ids]
+        cold_ids = {row.id for row in cold}
+        # 原始日期文本与 datetime 排序结果相同
+        rows = sort_tasks(hot + cold, sort_keys)
+    else:
+        stmt = select_task_rows(Task, user_id, q).where((Task.is_archived == False) | (Task.is_archived == None))
+        rows = db.session.execute(stmt.order_by(*task_order_by(Task, sort_keys))).all()
+        hot_ids, cold_ids = {row.id for row in rows}, set()
+
+    notes = fetch_note_rows(Note, hot_ids)
+    if cold_ids: notes.update(fetch_note_rows(ArchivedNote, cold_ids))
+
+    data = []
+    for row in rows:
+        in_cold = row.id in cold_ids
+        item = TASK_ROWS[ArchivedTask if in_cold else Task](row)
+        note_serializer = NOTE_ROWS[ArchivedNote if in_cold else Note]
+        item['notes'] = []
+        for note_row in notes.get(row.id, ()):
+            note_dict = note_serializer(note_row)
+            images = note_dict['images'] = parse_images(note_dict['images'])
+            note_dict['images_info'] = build_images_info(images, binary) if images else []
+            item['notes'].append(note_dict)
+        data.append(item)
+    return data
+
+# ==========================================
+# 笔记分页：按 created_at 倒序的游标分页
+# ==========================================
+# 游标是上一页最后一条笔记的 (created_at, id)，不受翻页期间新增笔记的影响。
+
+def note_model_for(task):
+    return ArchivedNote if isinstance(task, ArchivedTask) else Note
+
+def encode_note_cursor(note):
+    raw = f"{note.created_at.isoformat()}|{note.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_note_cursor(cursor):
+    try:
+        created_at, note_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+        return datetime.fromisoformat(created_at), note_id
+    except (ValueError, UnicodeError):
+        return None
+
+def get_notes_page(task, cursor=None, limit=None):
+    """返回 (笔记列表, 下一页游标)，没有更多时游标为 None"""
+    limit = max(1, min(limit or app.config['NOTES_PAGE_SIZE'], app.config['NOTES_PAGE_MAX']))
+    model = note_model_for(task)
+    query = model.query.filter(model.task_id == task.id)
+    position = decode_note_cursor(cursor) if cursor else None
+    if position:
+        created_at, note_id = position
+        query = query.filter((model.created_at < created_at) | ((model.created_at == created_at) & (model.id < note_id)))
+    notes = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_note_cursor(notes[limit - 1]) if len(notes) > limit else None
+    return notes[:limit], next_cursor
+
+def get_note_summary(task):
+    """笔记数与图片数，只读 images 字段做 JSON 计数，不加载笔记正文"""
+    model = note_model_for(task)
+    note_count, image_count = db.session.query(
+        db.func.count(model.id),
+        db.func.coalesce(db.func.sum(db.func.json_array_length(db.func.coalesce(model.images, '[]'))), 0)
+    ).filter(model.task_id == task.id).one()
+    return {'note_count': note_count, 'image_count': image_count}
+
+def get_request_user():
+    """
+    获取当前请求的用户：优先网页端 Session，其次 API 的 Basic Auth。
+    两者都失败时返回 None。
+    """
+    user = None
+    if current_user.is_authenticated:
+        user = current_user
+    else:
+        auth = request.authorization
+        if auth:
+            db_user = User.query.filter_by(username=auth.username).first()
+            if db_user and check_password_hash(db_user.password, auth.password):
+                user = db_user
+    # 分库模式下按这里认证出的用户选库
+    if user is not None: g.partition_user_id = user.id
+    return user
+
+# ==========================================
+# 并发准入控制：按通道 (lane) 限流，重活不挤占交互请求
+# ==========================================
+# Waitress 只有固定数量的工作线程。图片缩放、Word 导出这类重请求
+# 如果不加限制，几个并发就能占满所有线程，登录和 /api/tasks/<id>
+# 这类轻请求只能排队。这里把路由分到不同通道：
+#   - interactive: 默认通道，不限流
+#   - image:       serve_image 动态缩放
+#   - export:      download_task / batch_action 导出
+# 重通道同时占用的线程数最多为 "并发上限 + 排队上限"，超出直接 503。
+
+class Lane:
+    def __init__(self, name, limit=None, max_queue=0, queue_timeout=0):
+        self.name = name
+        self.limit = limit              # None 表示不限流
+        self.max_queue = max_queue      # 最多允许多少请求占着线程排队
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.peak = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """尝试进入通道，成功返回 True；队列已满或等待超时返回 False"""
+        with self._cond:
+            if self.limit is not None and self.active >= self.limit:
+                if self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.active >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timed_out += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            self.peak = max(self.peak, self.active)
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'max_queue': self.max_queue,
+                'queue_timeout': self.queue_timeout,
+                'active': self.active,
+                'waiting': self.waiting,
+                'peak': self.peak,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out
+            }
+
+def parse_lane_limits(spec):
+    """解析 "image=2:2:5,export=1:1:10" 形式的配置"""
+    lanes = {'interactive': Lane('interactive')}
+    for part in (spec or '').split(','):
+        if '=' not in part: continue
+        name, values = part.split('=', 1)
+        nums = (values.split(':') + ['0', '0'])[:3]
+        lanes[name.strip()] = Lane(name.strip(), limit=max(1, int(nums[0])), max_queue=int(nums[1]), queue_timeout=float(nums[2]))
+    return lanes
+
+LANES = parse_lane_limits(app.config['LANE_LIMITS'])
+
+# endpoint -> 通道名，未列出的都走 interactive
+LANE_ROUTES = {
+    'serve_image': 'image',
+    'download_task': 'export',
+}
+
+def classify_lane():
+    lane_name = LANE_ROUTES.get(request.endpoint, 'interactive')
+    # batch_action 只有导出是重活，归档/删除仍走交互通道
+    if request.endpoint == 'batch_action' and request.form.get('action_type') == 'export':
+        lane_name = 'export'
+    return LANES.get(lane_name, LANES['interactive'])
+
+@app.before_request
+def admission_control():
+    lane = classify_lane()
+    if not lane.acquire():
+        response = jsonify({'error': 'Server busy, please retry later', 'lane': lane.name})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['LANE_RETRY_AFTER'])
+        return response
+    g.lane = lane
+
+@app.teardown_request
+def release_lane(exc=None):
+    lane = g.pop('lane', None)
+    if lane is not None:
+        lane.release()
+
+@app.route('/api/lanes')
+def api_lanes():
+    """查看各通道当前占用情况"""
+    if not get_request_user(): return jsonify({'error': 'Auth required'}), 401
+    return jsonify({
+        'status': 'success',
+        'threads': app.config['WAITRESS_THREADS'],
+        'lanes': {name: lane.snapshot() for name, lane in LANES.items()},
+        'partitions': PARTITIONS.snapshot() if app.config['PARTITION_BY_USER'] else None
+    })
+
+# ==========================================
+# 传输格式协商与响应压缩
+# ==========================================
+# 客户端发送 "Accept: application/x-msgpack" 时，同步接口返回 MessagePack，
+# 缩略图以原始 JPEG 字节放在 'thumb' 字段，省掉 Base64 的 33% 膨胀。
+# 文本类响应按 Accept-Encoding 做 zstd / gzip 压缩。
+
+MSGPACK_MIMETYPES = ('application/x-msgpack', 'application/msgpack')
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/javascript', 'text/html', 'text/css',
+    'text/plain', 'text/javascript', 'application/x-msgpack', 'application/msgpack'
+}
+
+def wants_msgpack():
+    if msgpack is None: return False
+    best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+def api_response(payload, status=200):
+    """按协商结果返回 JSON 或 MessagePack"""
+    if wants_msgpack():
+        response = Response(msgpack.packb(payload, use_bin_type=True), status=status, mimetype='application/x-msgpack')
+    elif orjson is not None:
+        response = Response(orjson.dumps(payload), status=status, mimetype='application/json')
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    response.vary.add('Accept')
+    return response
+
+def choose_content_encoding():
+    accepted = request.accept_encodings
+    if zstandard is not None and accepted['zstd']: return 'zstd'
+    if accepted['gzip']: return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_content_encoding()
+    if encoding == 'zstd':
+        data = zstandard.ZstdCompressor(level=app.config['COMPRESS_LEVEL']).compress(data)
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# ==========================================
+# 按需性能剖析：只剖析带了密钥的那一个请求
+# ==========================================
+# 设置 PROFILE_SECRET 后，请求带上 "X-Profile: <密钥>" 头或 "?_profile=<密钥>"
+# 参数时，用 cProfile 跑完这个请求，连同每条 SQL 的耗时一起存到 PROFILE_DIR：
+#   <时间>-<id>.prof   pstats 格式，可用 snakeviz / python -m pstats 打开
+#   <时间>-<id>.json   请求信息、SQL 列表、最热函数
+# 只保留最近 PROFILE_KEEP 份。未设置 PROFILE_SECRET 时下面的钩子一个都不注册，
+# 普通请求没有任何额外开销。
+
+PROFILE_STATE = threading.local()
+
+def profile_key_matches(value):
+    secret = app.config['PROFILE_SECRET']
+    return bool(secret and value) and hmac.compare_digest(value.encode('utf-8'), secret.encode('utf-8'))
+
+def record_sql_start(conn, cursor, statement, parameters, context, executemany):
+    if getattr(PROFILE_STATE, 'queries', None) is not None:
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+def record_sql_end(conn, cursor, statement, parameters, context, executemany):
+    queries = getattr(PROFILE_STATE, 'queries', None)
+    if queries is not None and conn.info.get('profile_start'):
+        elapsed = time.perf_counter() - conn.info['profile_start'].pop()
+        queries.append({'statement': statement, 'ms': round(elapsed * 1000, 3)})
+
+def start_profile():
+    if request.endpoint in ('list_profiles', 'download_profile'): return
+    if not profile_key_matches(request.headers.get('X-Profile') or request.args.get('_profile')): return
+    PROFILE_STATE.queries = []
+    g.profile_started = time.perf_counter()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+def stop_profile():
+    """停止剖析并清理线程状态，返回 (profiler, SQL 列表, 耗时秒数)；没在剖析时返回 None"""
+    profiler = g.pop('profiler', None)
+    if profiler is None: return None
+    profiler.disable()
+    queries = PROFILE_STATE.queries
+    PROFILE_STATE.queries = None
+    return profiler, queries, time.perf_counter() - g.pop('profile_started')
+
+def hot_functions(stats, limit):
+    """按自身耗时排序的前 limit 个函数"""
+    rows = []
+    for (filename, line, name), (cc, nc, tt, ct, _) in stats.stats.items():
+        location = name if filename == '~' else f"{os.path.basename(filename)}:{line}({name})"
+        rows.append({'function': location, 'calls': nc, 'tottime_ms': round(tt * 1000, 3), 'cumtime_ms': round(ct * 1000, 3)})
+    rows.sort(key=lambda r: r['tottime_ms'], reverse=True)
+    return rows[:limit]
+
+def list_profile_reports():
+    """最近的剖析报告 (新的在前)"""
+    profile_dir = app.config['PROFILE_DIR']
+    if not os.path.isdir(profile_dir): return []
+    reports = []
+    for name in sorted((f for f in os.listdir(profile_dir) if f.endswith('.json')), reverse=True):
+        try:
+            with open(os.path.join(profile_dir, name)) as f: reports.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return reports
+
+def save_profile(profiler, queries, duration, response):
+    profile_dir = app.config['PROFILE_DIR']
+    os.makedirs(profile_dir, exist_ok=True)
+    now = datetime.now()
+    profile_id = f"{now.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    stats = pstats.Stats(profiler)
+    user = current_user if current_user.is_authenticated else get_request_user()
+    report = {
+        'id': profile_id,
+        'created_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'user': user.username if user else None,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 3),
+        'sql_count': len(queries),
+        'sql_ms': round(sum(q['ms'] for q in queries), 3),
+        'sql': queries,
+        'hot_functions': hot_functions(stats, app.config['PROFILE_TOP'])
+    }
+    # 查询参数里的密钥不落盘
+    if app.config['PROFILE_SECRET'] in report['path']:
+        report['path'] = report['path'].replace(app.config['PROFILE_SECRET'], '***')
+    atomic_write(os.path.join(profile_dir, profile_id + '.prof'), lambda f: marshal.dump(stats.stats, f))
+    atomic_write(os.path.join(profile_dir, profile_id + '.json'),
+                 lambda f: f.write(json.dumps(report, ensure_ascii=False, indent=2).encode('utf-8')))
+
+    keep = app.config['PROFILE_KEEP']
+    reports = sorted(f.rsplit('.', 1)[0] for f in os.listdir(profile_dir) if f.endswith('.json'))
+    for old in reports[:-keep] if keep > 0 else []:
+        for ext in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(profile_dir, old + ext))
+            except FileNotFoundError:
+                pass
+    return profile_id
+
+def finish_profile(response):
+    result = stop_profile()
+    if result is None: return response
+    try:
+        response.headers['X-Profile-Id'] = save_profile(*result, response)
+    except Exception as e:
+        print(f"⚠️ 保存性能剖析失败: {e}")
+    return response
+
+def abort_profile(exc=None):
+    # 未处理的异常不会走 after_request，这里兜底停掉剖析器
+    stop_profile()
+
+if app.config['PROFILE_SECRET']:
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(abort_profile)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', record_sql_start)
+        event.listen(db.engine, 'after_cursor_execute', record_sql_end)
+
+@app.route('/_profiles')
+def list_profiles():
+    """最近的剖析报告与最热函数，需带上密钥访问"""
+    key = request.headers.get('X-Profile') or request.args.get('key')
+    if not profile_key_matches(key): abort(404)
+    return render_template('profiles.html', reports=list_profile_reports(), key=key)
+
+@app.route('/_profiles/<profile_id>.prof')
+def download_profile(profile_id):
+    if not profile_key_matches(request.headers.get('X-Profile') or request.args.get('key')): abort(404)
+    return send_from_directory(app.config['PROFILE_DIR'], secure_filename(profile_id) + '.prof', as_attachment=True)
+
 # --- WEB 路由 (UUID 兼容，移除 int: 类型限制) ---
 
 @app.route('/')
@@ -299,9 +1643,22 @@ def dashboard():
 @app.route('/task/<task_id>') # 移除 int:
 @login_required
 def task_details(task_id):
-    task = Task.query.get_or_404(task_id) 
+    task = find_task(task_id)
+    if not task: abort(404)
     if task.user_id != current_user.id: return redirect(url_for('dashboard'))
-    return render_template('task_details.html', task=task)
+    notes, next_cursor = get_notes_page(task)
+    return render_template('task_details.html', task=task, notes=notes, next_cursor=next_cursor, summary=get_note_summary(task))
+
+@app.route('/task/<task_id>/notes')
+@login_required
+def task_notes_fragment(task_id):
+    """详情页滚动加载：返回下一页笔记的 HTML 片段，下一页游标放在 X-Next-Cursor 头里"""
+    task = find_task(task_id)
+    if not task or task.user_id != current_user.id: abort(404)
+    notes, next_cursor = get_notes_page(task, request.args.get('cursor'))
+    response = Response(render_template('note_list.html', notes=notes))
+    response.headers['X-Next-Cursor'] = next_cursor or ''
+    return response
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -333,7 +1690,7 @@ def logout(): logout_user(); return redirect(url_for('login'))
 @app.route('/add_task', methods=['POST'])
 @login_required
 def add_task():
-    new_task = Task(
+    fields = dict(
         title=request.form.get('title'), 
         category=request.form.get('category') or '其他', 
         priority=request.form.get('priority'), 
@@ -344,15 +1701,16 @@ def add_task():
         is_recurring=True if request.form.get('recurrence_days') and int(request.form.get('recurrence_days')) > 0 else False,
         recurrence_days=int(request.form.get('recurrence_days') or 0)
     )
-    db.session.add(new_task)
-    db.session.commit() # updated_at/created_at 自动设置
+    commit_write(lambda: db.session.add(Task(**fields))) # updated_at/created_at 自动设置
     return redirect(url_for('dashboard'))
 
 @app.route('/edit_task', methods=['POST'])
 @login_required
 def edit_task():
-    task = Task.query.get_or_404(request.form.get('task_id')) # task_id 是 UUID 字符串
+    task = find_task(request.form.get('task_id')) # task_id 是 UUID 字符串
+    if not task: abort(404)
     if task.user_id == current_user.id:
+        task = get_hot_task(task.id)
         task.title = request.form.get('title')
         task.category = request.form.get('category') or '其他'
         task.content = request.form.get('content')
@@ -369,24 +1727,33 @@ def edit_task():
 @app.route('/complete/<id>') # 移除 int:
 @login_required
 def complete_task(id):
-    task = Task.query.get_or_404(id)
+    task = find_task(id)
+    if not task: abort(404)
     if task.user_id == current_user.id:
-        task.completed = not task.completed
-        task.completed_at = datetime.now() if task.completed else None
-        if task.completed and task.is_recurring and task.recurrence_days > 0:
-            next_due = task.due_date + timedelta(days=task.recurrence_days) if task.due_date else datetime.now() + timedelta(days=task.recurrence_days)
-            # 新任务使用新的 UUID
-            new_task = Task(title=f"{task.title} (循环)", category=task.category, priority=task.priority, content=task.content, user_id=task.user_id, start_date=datetime.now(), due_date=next_due, is_recurring=True, recurrence_days=task.recurrence_days)
-            db.session.add(new_task)
-            flash('循环任务已生成')
-        db.session.commit()
+        task_id = get_hot_task(id).id
+
+        def toggle():
+            task = Task.query.get(task_id)
+            if not task: return False
+            task.completed = not task.completed
+            task.completed_at = datetime.now() if task.completed else None
+            if task.completed and task.is_recurring and task.recurrence_days > 0:
+                next_due = task.due_date + timedelta(days=task.recurrence_days) if task.due_date else datetime.now() + timedelta(days=task.recurrence_days)
+                # 新任务使用新的 UUID
+                new_task = Task(title=f"{task.title} (循环)", category=task.category, priority=task.priority, content=task.content, user_id=task.user_id, start_date=datetime.now(), due_date=next_due, is_recurring=True, recurrence_days=task.recurrence_days)
+                db.session.add(new_task)
+                return True
+            return False
+
+        if commit_write(toggle): flash('循环任务已生成')
     return redirect(request.referrer or url_for('dashboard'))
 
 @app.route('/delete/<id>') # 移除 int:
 @login_required
 def delete_task(id):
-    task = Task.query.get_or_404(id)
-    if task.user_id == current_user.id: db.session.delete(task); db.session.commit()
+    task = find_task(id)
+    if not task: abort(404)
+    if task.user_id == current_user.id: db.session.delete(get_hot_task(id)); db.session.commit()
     return redirect(url_for('dashboard'))
 
 @app.route('/uploads/<filename>')
@@ -408,8 +1775,6 @@ def uploaded_file(filename):
         
         # 使用 send_from_directory 替代手动读取
         # 它会自动处理文件发送、缓存、断点续传等
-        from flask import send_from_directory
-        
         # 设置较长的缓存时间（1小时）以减轻服务器压力
         response = send_from_directory(
             app.config['UPLOAD_FOLDER'], 
@@ -446,17 +1811,25 @@ def serve_image(filename):
         ext = os.path.splitext(filename)[1].lower()
         
         if ext in image_extensions:
-            # 对于图片文件，可以添加图片优化
-            # 例如：压缩、格式转换、调整大小等
-            from PIL import Image
-            import io
-            
             # 获取请求参数
             quality = request.args.get('quality', 85, type=int)
             width = request.args.get('width', type=int)
             height = request.args.get('height', type=int)
             
-            with Image.open(file_path) as img:
+            # 计算目标尺寸（基于旋正后的尺寸），只解码到够用的分辨率
+            target = None
+            if width or height:
+                original_width, original_height = oriented_size(file_path)
+                
+                # 保持宽高比
+                if width and not height:
+                    height = int(original_height * width / original_width)
+                elif height and not width:
+                    width = int(original_width * height / original_height)
+                target = (max(1, width), max(1, height))
+            
+            img = decode_image(file_path, target)
+            try:
                 # 转换模式（如果是RGBA转换为RGB）
                 if img.mode in ('RGBA', 'LA', 'P'):
                     if img.mode == 'P' and 'transparency' in img.info:
@@ -465,19 +1838,11 @@ def serve_image(filename):
                         img = img.convert('RGB')
                 
                 # 调整大小（如果有指定）
-                if width or height:
-                    original_width, original_height = img.size
-                    
-                    # 保持宽高比
-                    if width and not height:
-                        height = int(original_height * width / original_width)
-                    elif height and not width:
-                        width = int(original_width * height / original_height)
-                    
-                    img = img.resize((width, height), Image.Resampling.LANCZOS)
+                if target:
+                    img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
                 
                 # 保存到内存
-                output = io.BytesIO()
+                output = BytesIO()
                 img.save(output, format='JPEG' if ext in {'.jpg', '.jpeg'} else 'PNG', 
                          quality=quality, optimize=True)
                 output.seek(0)
@@ -488,6 +1853,8 @@ def serve_image(filename):
                 response.headers['Access-Control-Allow-Origin'] = '*'
                 
                 return response
+            finally:
+                img.close()
         else:
             # 非图片文件，直接发送
             return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
@@ -503,8 +1870,10 @@ def serve_image(filename):
 @app.route('/archive/<id>') # 移除 int:
 @login_required
 def archive_task(id):
-    task = Task.query.get_or_404(id)
+    task = find_task(id)
+    if not task: abort(404)
     if task.user_id == current_user.id:
+        task = get_hot_task(id)
         task.is_archived = True
         task.archived_at = datetime.now()
         db.session.commit()
@@ -514,14 +1883,77 @@ def archive_task(id):
 @app.route('/unarchive/<id>') # 移除 int:
 @login_required
 def unarchive_task(id):
-    task = Task.query.get_or_404(id)
+    task = find_task(id)
+    if not task: abort(404)
     if task.user_id == current_user.id:
+        task = get_hot_task(id) # 冷库中的任务会先搬回热表
         task.is_archived = False
         task.archived_at = None
         db.session.commit()
         flash('任务已恢复')
     return redirect(request.referrer or url_for('dashboard'))
 
+# ==========================================
+# Word 导出缓存：任务没变就直接发磁盘上的 .docx
+# ==========================================
+# 缓存文件名为 "<键>_<版本>.docx"。键是 用户 id + 任务 id 的哈希：任务 id 由
+# 客户端指定，不能直接拼进路径，而且分库后不同用户可能有相同的任务 id。
+# 版本由任务与其笔记的最新 updated_at 加上笔记条数算出 (删笔记不会刷新
+# 其它行的 updated_at，所以要带上条数)。
+# 生成新版本时删掉同一任务的旧版本；总大小超过 DOCX_CACHE_MAX_MB 时
+# 按 mtime 淘汰最久未用的文件，命中时刷新 mtime，即 LRU。
+
+def docx_cache_key(task):
+    return hashlib.sha1(f"{task.user_id}:{task.id}".encode('utf-8')).hexdigest()[:24]
+
+def task_revision(task):
+    model = note_model_for(task)
+    latest, count = db.session.query(db.func.max(model.updated_at), db.func.count(model.id)).filter(model.task_id == task.id).one()
+    raw = f"{task.updated_at.isoformat() if task.updated_at else ''}|{latest.isoformat() if latest else ''}|{count}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+def evict_docx_cache(cache_dir, keep):
+    """淘汰最久未用的文件直到不超预算，keep (刚生成的文件) 本身超预算时也保留"""
+    budget = app.config['DOCX_CACHE_MAX_MB'] * 1024 * 1024
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.docx') or entry.path == keep: continue
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries) + os.path.getsize(keep)
+    for _, size, path in sorted(entries):
+        if total <= budget: break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def get_task_docx(task):
+    """返回任务 .docx 的缓存路径，版本变化或未缓存时重新生成"""
+    cache_dir = app.config['DOCX_CACHE_DIR']
+    key = docx_cache_key(task)
+    path = os.path.join(cache_dir, f"{key}_{task_revision(task)}.docx")
+    try:
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    os.makedirs(cache_dir, exist_ok=True)
+    doc = create_task_docx(task)
+    atomic_write(path, doc.save)
+    for name in os.listdir(cache_dir):
+        if name.startswith(key + '_') and name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+    evict_docx_cache(cache_dir, path)
+    return path
+
 def create_task_docx(task):
     doc = Document()
     doc.add_heading(task.title, 0)
@@ -543,42 +1975,29 @@ def create_task_docx(task):
 @app.route('/download_task/<task_id>') 
 # 注意：这里去掉了 @login_required，改为函数内部手动验证
 def download_task(task_id):
-    # 1. 优先尝试获取网页端登录用户 (Session / Cookie)
-    user = None
-    if current_user.is_authenticated:
-        user = current_user
-    
-    # 2. 如果网页端没登录，尝试获取 API 认证信息 (安卓端 Basic Auth)
-    if not user:
-        auth = request.authorization
-        if auth:
-            # 在数据库查找用户并验证密码
-            db_user = User.query.filter_by(username=auth.username).first()
-            if db_user and check_password_hash(db_user.password, auth.password):
-                user = db_user
+    # 1-2. 优先网页端登录用户 (Session / Cookie)，其次安卓端 Basic Auth
+    user = get_request_user()
 
     # 3. 如果两种方式都失败，返回 401 未授权
     if not user:
         return jsonify({'error': 'Unauthorized - Please login or provide credentials'}), 401
 
     # 4. 获取任务并校验权限 (防止下载别人的任务)
-    task = Task.query.get_or_404(task_id)
+    task = find_task(task_id)
+    if not task: abort(404)
     if task.user_id != user.id: 
         return jsonify({'error': 'Forbidden - You do not own this task'}), 403
 
     # 5. 生成文档并下载 (原有逻辑)
     try:
-        doc = create_task_docx(task)
-        f = BytesIO()
-        doc.save(f)
-        f.seek(0)
+        path = get_task_docx(task)
         # 生成安全的文件名
         safe_name = secure_filename(f"{task.title}.docx")
         # 针对中文文件名可能被 secure_filename 过滤为空的情况做个保底
         if not safe_name: 
             safe_name = f"task_{task.id}.docx"
             
-        return send_file(f, as_attachment=True, download_name=safe_name)
+        return send_file(path, as_attachment=True, download_name=safe_name)
     except Exception as e:
         print(f"Download Error: {e}")
         return jsonify({'error': 'Failed to generate document'}), 500
@@ -589,11 +2008,11 @@ def batch_action():
     task_ids = request.form.getlist('task_ids[]') 
     action_type = request.form.get('action_type')
     if not task_ids: return redirect(request.referrer)
-    tasks = Task.query.filter(Task.id.in_(task_ids)).all()
+    tasks = find_tasks(task_ids) # 包含冷库中的任务
     
     if action_type == 'archive':
         for task in tasks:
-            if task.user_id == current_user.id:
+            if task.user_id == current_user.id and isinstance(task, Task):
                 task.is_archived = True
                 task.archived_at = datetime.now()
         db.session.commit()
@@ -606,11 +2025,9 @@ def batch_action():
         with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
             for task in tasks:
                 if task.user_id != current_user.id: continue
-                doc = create_task_docx(task)
-                docx_io = BytesIO()
-                doc.save(docx_io)
                 safe_title = secure_filename(task.title) or f"task_{task.id}"
-                zf.writestr(f"{safe_title}.docx", docx_io.getvalue())
+                # .docx 本身就是 zip，直接存储不再压缩
+                zf.write(get_task_docx(task), f"{safe_title}.docx", compress_type=zipfile.ZIP_STORED)
         memory_file.seek(0)
         return send_file(memory_file, download_name=f"export_{datetime.now().strftime('%Y%m%d')}.zip", as_attachment=True)
     return redirect(request.referrer)
@@ -625,26 +2042,23 @@ def batch_action():
 @login_required
 def add_note(task_id):
     # 使用字符串 ID 查询
-    task = Task.query.get_or_404(task_id)
+    task = find_task(task_id)
+    if not task: abort(404)
     if task.user_id != current_user.id: 
         return redirect(url_for('dashboard'))
+    task = get_hot_task(task_id)
     
     files = request.files.getlist('images')
     saved_images = []
     for file in files:
         if file and file.filename:
-            filename = secure_filename(f"{datetime.now().timestamp()}_{file.filename}")
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(save_path)
-            # 生成缩略图
-            create_thumbnail(save_path)
-            saved_images.append(filename)
+            # 保存原图并生成缩略图
+            saved_images.append(save_upload(file))
             
     # task.id 是字符串，这里直接用
-    new_note = Note(content=request.form.get('content'), images=json.dumps(saved_images), task_id=task.id)
-    db.session.add(new_note)
-    db.session.commit()
-    return redirect(url_for('task_details', task_id=task.id))
+    fields = dict(content=request.form.get('content'), images=json.dumps(saved_images), task_id=task.id)
+    commit_write(lambda: db.session.add(Note(**fields)))
+    return redirect(url_for('task_details', task_id=fields['task_id']))
 
 # 2. 网页端编辑笔记
 @app.route('/edit_note', methods=['POST'])
@@ -652,10 +2066,12 @@ def add_note(task_id):
 def edit_note():
     # 从表单获取 note_id (字符串)
     note_id = request.form.get('note_id')
-    note = Note.query.get_or_404(note_id)
+    note = find_note(note_id)
+    if not note: abort(404)
     
     if note.task.user_id != current_user.id: 
         return redirect(url_for('dashboard'))
+    note = get_hot_note(note_id)
         
     note.content = request.form.get('content')
     
@@ -667,10 +2083,7 @@ def edit_note():
     # 处理新图片上传
     for file in request.files.getlist('new_images'):
         if file and file.filename:
-            filename = secure_filename(f"{datetime.now().timestamp()}_{file.filename}")
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            create_thumbnail(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            current_images.append(filename)
+            current_images.append(save_upload(file))
             
     note.images = json.dumps(current_images)
     db.session.commit() # onupdate 会自动更新 updated_at
@@ -680,10 +2093,11 @@ def edit_note():
 @app.route('/delete_note/<note_id>') # 已修复：去掉了 int:
 @login_required
 def delete_note(note_id):
-    note = Note.query.get_or_404(note_id)
+    note = find_note(note_id)
+    if not note: abort(404)
     tid = note.task_id
     if note.task.user_id == current_user.id: 
-        db.session.delete(note)
+        db.session.delete(get_hot_note(note_id))
         db.session.commit()
     return redirect(url_for('task_details', task_id=tid))
 
@@ -699,43 +2113,11 @@ def api_get_tasks():
     if not user or not check_password_hash(user.password, auth.password): return jsonify({'error': 'Invalid'}), 401
 
     show_archived = request.args.get('show_archived', 'false') == 'true'
-    sort_by = request.args.get('sort_by', 'default')
+    sort_keys = TASK_SORTS.get(request.args.get('sort_by', 'default'), API_DEFAULT_SORT)
     q = request.args.get('q')
     
-    query = Task.query.filter_by(user_id=user.id)
-    if show_archived: query = query.filter(Task.is_archived == True)
-    else: query = query.filter((Task.is_archived == False) | (Task.is_archived == None))
-    
-    if q:
-        search = f"%{q}%"
-        query = query.filter((Task.title.like(search)) | (Task.content.like(search)) | (Task.category.like(search)))
-        
-    if sort_by == 'created_desc': query = query.order_by(Task.created_at.desc())
-    elif sort_by == 'created_asc': query = query.order_by(Task.created_at.asc())
-    elif sort_by == 'completed_desc': query = query.order_by(Task.completed_at.desc())
-    elif sort_by == 'due_date': query = query.order_by(Task.due_date.asc())
-    else: query = query.order_by(Task.created_at.desc())
-
-    tasks = query.all()
-    data = []
-    upload_folder = app.config['UPLOAD_FOLDER']
-    for t in tasks:
-        item = t.to_dict()
-        item['notes'] = []
-        for n in t.notes:
-            note_dict = n.to_dict()
-            images_info = []
-            for img in n.get_images():
-                full_url = url_for('serve_image', filename=img, _external=True)
-                thumb_name = img.rsplit('.', 1)[0] + '_thumb.jpg'
-                thumb_path = os.path.join(upload_folder, thumb_name)
-                if not os.path.exists(thumb_path): create_thumbnail(os.path.join(upload_folder, img))
-                base64_str = image_to_base64(thumb_path)
-                images_info.append({'original_url': full_url, 'thumb_base64': base64_str, 'filename': img})
-            note_dict['images_info'] = images_info
-            item['notes'].append(note_dict)
-        data.append(item)
-    return jsonify({'status': 'success', 'data': data})
+    data = list_task_dicts(user.id, show_archived, q, sort_keys, wants_msgpack())
+    return api_response({'status': 'success', 'data': data})
 
 # 2. 新增任务 (支持客户端生成 UUID)
 @app.route('/api/tasks', methods=['POST'])
@@ -758,10 +2140,10 @@ def api_create_task():
         
     task_id = data.get('id', str(uuid.uuid4()))
     
-    if Task.query.get(task_id):
+    if find_task(task_id):
         return jsonify({'error': 'Task ID already exists'}), 409
 
-    new_task = Task(
+    fields = dict(
         id=task_id,
         title=data['title'],
         category=data.get('category', '其他'),
@@ -772,10 +2154,9 @@ def api_create_task():
         user_id=user.id,
         created_at=datetime.now()
     )
-    db.session.add(new_task)
-    db.session.commit()
+    commit_write(lambda: db.session.add(Task(**fields)))
     
-    return jsonify({'status': 'success', 'message': 'Task created', 'id': new_task.id})
+    return jsonify({'status': 'success', 'message': 'Task created', 'id': task_id})
 
 # 3. 单个任务操作 (支持 UUID URL)
 @app.route('/api/tasks/<task_id>', methods=['GET', 'PUT', 'DELETE']) # 移除 int:
@@ -785,59 +2166,90 @@ def api_task_action(task_id):
     user = User.query.filter_by(username=auth.username).first()
     if not user or not check_password_hash(user.password, auth.password): return jsonify({'error': 'Invalid'}), 401
 
-    task = Task.query.get(task_id)
+    task = find_task(task_id)
     if not task or task.user_id != user.id: return jsonify({'error': 'Task not found'}), 404
+    # 修改/删除前把冷库中的任务搬回热表
+    if request.method != 'GET': task = get_hot_task(task_id)
 
     if request.method == 'GET':
+        binary = wants_msgpack()
         item = task.to_dict()
+        item.update(get_note_summary(task))
+        # 传了 notes_limit 时只返回最新一页笔记，其余通过 /api/tasks/<id>/notes 翻页
+        notes_limit = request.args.get('notes_limit', type=int)
+        if notes_limit:
+            notes, item['notes_next_cursor'] = get_notes_page(task, limit=notes_limit)
+        else:
+            notes = task.notes
         item['notes'] = []
-        upload_folder = app.config['UPLOAD_FOLDER']
-        for n in task.notes:
+        for n in notes:
             note_dict = n.to_dict()
-            images_info = []
-            for img in n.get_images():
-                full_url = url_for('serve', filename=img, _external=True)
-                thumb_name = img.rsplit('.', 1)[0] + '_thumb.jpg'
-                thumb_path = os.path.join(upload_folder, thumb_name)
-                if not os.path.exists(thumb_path): create_thumbnail(os.path.join(upload_folder, img))
-                base64_str = image_to_base64(thumb_path)
-                images_info.append({'original_url': full_url, 'thumb_base64': base64_str, 'filename': img})
-            note_dict['images_info'] = images_info
+            note_dict['images_info'] = build_images_info(n.get_images(), binary)
             item['notes'].append(note_dict)
-        return jsonify({'status': 'success', 'data': item})
+        return api_response({'status': 'success', 'data': item})
 
     elif request.method == 'PUT':
         data = request.json
-        if 'title' in data: task.title = data['title']
-        if 'content' in data: task.content = data['content']
-        if 'category' in data: task.category = data['category']
-        if 'priority' in data: task.priority = data['priority']
-        
-        if 'start_date' in data:
-            try: task.start_date = datetime.strptime(data['start_date'], '%Y-%m-%d %H:%M') if data['start_date'] else None
-            except: pass
-        if 'due_date' in data:
-            try: task.due_date = datetime.strptime(data['due_date'], '%Y-%m-%d %H:%M') if data['due_date'] else None
-            except: pass
+
+        def update():
+            task = Task.query.get(task_id)
+            if not task: return False
+            if 'title' in data: task.title = data['title']
+            if 'content' in data: task.content = data['content']
+            if 'category' in data: task.category = data['category']
+            if 'priority' in data: task.priority = data['priority']
             
-        if 'completed' in data: 
-            task.completed = bool(data['completed'])
-            if task.completed and not task.completed_at: task.completed_at = datetime.now()
-            elif not task.completed: task.completed_at = None
-        
-        if 'is_archived' in data:
-            task.is_archived = bool(data['is_archived'])
-            if task.is_archived and not task.archived_at: task.archived_at = datetime.now()
-            elif not task.is_archived: task.archived_at = None
+            if 'start_date' in data:
+                try: task.start_date = datetime.strptime(data['start_date'], '%Y-%m-%d %H:%M') if data['start_date'] else None
+                except: pass
+            if 'due_date' in data:
+                try: task.due_date = datetime.strptime(data['due_date'], '%Y-%m-%d %H:%M') if data['due_date'] else None
+                except: pass
+                
+            if 'completed' in data: 
+                task.completed = bool(data['completed'])
+                if task.completed and not task.completed_at: task.completed_at = datetime.now()
+                elif not task.completed: task.completed_at = None
+            
+            if 'is_archived' in data:
+                task.is_archived = bool(data['is_archived'])
+                if task.is_archived and not task.archived_at: task.archived_at = datetime.now()
+                elif not task.is_archived: task.archived_at = None
+            return True
 
-        db.session.commit() # updated_at 自动刷新
+        if not commit_write(update): return jsonify({'error': 'Task not found'}), 404 # updated_at 自动刷新
         return jsonify({'status': 'success', 'message': 'Task updated'})
 
     elif request.method == 'DELETE':
-        db.session.delete(task)
-        db.session.commit()
+        def delete():
+            task = Task.query.get(task_id)
+            if task: db.session.delete(task)
+            return task is not None
+
+        if not commit_write(delete): return jsonify({'error': 'Task not found'}), 404
         return jsonify({'status': 'success', 'message': 'Task deleted'})
 
+# 3.1 分页获取任务笔记 (最新在前)
+@app.route('/api/tasks/<task_id>/notes', methods=['GET'])
+def api_task_notes(task_id):
+    user = get_request_user()
+    if not user: return jsonify({'error': 'Auth required'}), 401
+
+    task = find_task(task_id)
+    if not task or task.user_id != user.id: return jsonify({'error': 'Task not found'}), 404
+
+    cursor = request.args.get('cursor')
+    notes, next_cursor = get_notes_page(task, cursor, request.args.get('limit', type=int))
+    binary = wants_msgpack()
+    data = []
+    for n in notes:
+        note_dict = n.to_dict()
+        note_dict['images_info'] = build_images_info(n.get_images(), binary)
+        data.append(note_dict)
+    payload = {'status': 'success', 'data': data, 'next_cursor': next_cursor, 'has_more': next_cursor is not None}
+    if not cursor: payload.update(get_note_summary(task)) # 汇总只在第一页返回
+    return api_response(payload)
+
 # 4. 新增笔记 (支持客户端生成 UUID)
 @app.route('/api/notes', methods=['POST'])
 def api_add_note():
@@ -852,28 +2264,31 @@ def api_add_note():
     note_id = request.form.get('id', str(uuid.uuid4()))
     
     if not task_id: return jsonify({'error': 'Task ID required'}), 400
-    task = Task.query.get(task_id) 
+    task = find_task(task_id)
     if not task or task.user_id != user.id: return jsonify({'error': 'Task not found'}), 404
+    task = get_hot_task(task_id)
 
-    saved_images = []
+    saved_images, error = claim_uploads(user, request.form.getlist('upload_ids'))
+    if error: return jsonify({'error': error}), 400
     files = request.files.getlist('images')
     for file in files:
         if file and file.filename:
-            filename = secure_filename(f"{datetime.now().timestamp()}_{file.filename}")
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(save_path)
-            create_thumbnail(save_path)
-            saved_images.append(filename)
+            saved_images.append(save_upload(file))
 
-    new_note = Note(
+    upload_ids = request.form.getlist('upload_ids')
+    fields = dict(
         id=note_id, 
         content=content, 
         images=json.dumps(saved_images), 
         task_id=task.id
     )
-    db.session.add(new_note)
-    db.session.commit()
-    return jsonify({'status': 'success', 'message': 'Note added', 'note_id': new_note.id})
+
+    def add():
+        db.session.add(Note(**fields))
+        delete_upload_sessions(upload_ids)
+
+    commit_write(add)
+    return jsonify({'status': 'success', 'message': 'Note added', 'note_id': note_id})
 
 # 5. 编辑笔记 (支持 UUID Note ID)
 @app.route('/api/notes/<note_id>', methods=['PUT']) # 移除 int:
@@ -883,25 +2298,34 @@ def api_edit_note(note_id):
     user = User.query.filter_by(username=auth.username).first()
     if not user or not check_password_hash(user.password, auth.password): return jsonify({'error': 'Invalid'}), 401
 
-    note = Note.query.get(note_id)
+    note = find_note(note_id)
     if not note or note.task.user_id != user.id: return jsonify({'error': 'Note not found'}), 404
+    note = get_hot_note(note_id)
 
-    if 'content' in request.form: note.content = request.form.get('content')
     current_images = note.get_images()
     delete_images = request.form.getlist('delete_images')
     for img in delete_images:
         if img in current_images: current_images.remove(img)
+    upload_ids = request.form.getlist('upload_ids')
+    claimed, error = claim_uploads(user, upload_ids)
+    if error: return jsonify({'error': error}), 400
+    current_images.extend(claimed)
     new_files = request.files.getlist('new_images')
     for file in new_files:
         if file and file.filename:
-            filename = secure_filename(f"{datetime.now().timestamp()}_{file.filename}")
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(save_path)
-            create_thumbnail(save_path)
-            current_images.append(filename)
-    
-    note.images = json.dumps(current_images)
-    db.session.commit()
+            current_images.append(save_upload(file))
+
+    content = request.form.get('content')
+
+    def update():
+        note = Note.query.get(note_id)
+        if not note: return False
+        if content is not None: note.content = content
+        note.images = json.dumps(current_images)
+        delete_upload_sessions(upload_ids)
+        return True
+
+    if not commit_write(update): return jsonify({'error': 'Note not found'}), 404
     return jsonify({'status': 'success', 'message': 'Note updated'})
 
 # 6. 删除笔记 (支持 UUID Note ID)
@@ -912,13 +2336,193 @@ def api_delete_note(note_id):
     user = User.query.filter_by(username=auth.username).first()
     if not user or not check_password_hash(user.password, auth.password): return jsonify({'error': 'Invalid'}), 401
 
-    note = Note.query.get(note_id)
+    note = find_note(note_id)
     if not note or note.task.user_id != user.id: return jsonify({'error': 'Not found'}), 404
-    
-    db.session.delete(note)
-    db.session.commit()
+    note = get_hot_note(note_id)
+
+    def delete():
+        note = Note.query.get(note_id)
+        if note: db.session.delete(note)
+        return note is not None
+
+    if not commit_write(delete): return jsonify({'error': 'Not found'}), 404
     return jsonify({'status': 'success', 'message': 'Note deleted'})
 
+# ==========================================
+# 分块续传：弱网下多图上传断了只需补传缺失的部分
+# ==========================================
+# 1. POST   /api/uploads              {filename, size, sha256?} -> upload_id
+# 2. PUT    /api/uploads/<id>?offset=N  请求体为原始字节，offset 必须等于已接收字节数
+# 3. GET    /api/uploads/<id>           查询已接收字节数，断线后从这里继续
+# 4. 收满 size 字节后自动落盘并生成缩略图，再在 /api/notes 的 upload_ids 字段里引用
+# DELETE /api/uploads/<id> 取消上传。
+
+# upload_id -> (已哈希到的偏移, hashlib 对象)。进程重启或请求落到别的 worker 时，
+# 缓存缺失会从临时文件重新计算前缀哈希，结果不受影响。
+UPLOAD_HASHERS = {}
+UPLOAD_HASHERS_LOCK = threading.Lock()
+
+def hash_file_prefix(path, length):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = length
+        while remaining > 0:
+            block = f.read(min(remaining, 1024 * 1024))
+            if not block: break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+def update_upload_hash(upload, offset, chunk):
+    """
+    返回包含本块的新 hasher。缓存里的对象只复制不修改：并发重试同一块时
+    各自在副本上计算，由 remember_upload_hash 在推进 received 成功后才写回缓存。
+    """
+    with UPLOAD_HASHERS_LOCK:
+        cached = UPLOAD_HASHERS.get(upload.id)
+    if cached and cached[0] == offset:
+        hasher = cached[1].copy()
+    else:
+        hasher = hash_file_prefix(upload.partial_path(), offset)
+    hasher.update(chunk)
+    return hasher
+
+def remember_upload_hash(upload, received, hasher):
+    with UPLOAD_HASHERS_LOCK:
+        UPLOAD_HASHERS[upload.id] = (received, hasher)
+
+def discard_upload(upload):
+    """删除会话及其文件：笔记引用上传后会话即被删除，所以已完成会话的原图和缩略图也一并删掉"""
+    with UPLOAD_HASHERS_LOCK:
+        UPLOAD_HASHERS.pop(upload.id, None)
+    paths = [upload.partial_path()]
+    if upload.stored_filename:
+        paths += [os.path.join(app.config['UPLOAD_FOLDER'], name)
+                  for name in (upload.stored_filename, upload.stored_filename.rsplit('.', 1)[0] + '_thumb.jpg')]
+    for path in paths:
+        try: os.remove(path)
+        except OSError: pass
+    db.session.delete(upload)
+
+def cleanup_stale_uploads():
+    """删除超过保留时间的会话 (包括已完成但始终没有被笔记引用的)"""
+    cutoff = datetime.now() - timedelta(hours=app.config['UPLOAD_SESSION_TTL_HOURS'])
+    for upload in UploadSession.query.filter(UploadSession.updated_at < cutoff).all():
+        discard_upload(upload)
+
+def finalize_upload(upload, hasher):
+    """收满后校验、落盘到 uploads 目录并生成缩略图"""
+    digest = hasher.hexdigest()
+    if upload.sha256 and upload.sha256.lower() != digest:
+        # 校验失败：清空已接收内容，让客户端从头再传
+        upload.received = 0
+        with UPLOAD_HASHERS_LOCK:
+            UPLOAD_HASHERS.pop(upload.id, None)
+        open(upload.partial_path(), 'wb').close()
+        return digest, False
+    filename = make_upload_filename(upload.filename)
+    save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    os.chmod(upload.partial_path(), 0o644)
+    os.replace(upload.partial_path(), save_path)
+    create_thumbnail(save_path)
+    with UPLOAD_HASHERS_LOCK:
+        UPLOAD_HASHERS.pop(upload.id, None)
+    upload.stored_filename = filename
+    upload.completed = True
+    return digest, True
+
+def claim_uploads(user, upload_ids):
+    """
+    检查要挂到笔记上的上传会话：返回 (文件名列表, 错误信息)。
+    会话由 delete_upload_sessions 在笔记的写操作单元里一并删除，文件本身保留在 uploads 目录中。
+    """
+    filenames = []
+    for upload_id in upload_ids:
+        upload = UploadSession.query.get(upload_id)
+        if not upload or upload.user_id != user.id:
+            return [], f'Upload {upload_id} not found'
+        if not upload.completed:
+            return [], f'Upload {upload_id} is not completed'
+        filenames.append(upload.stored_filename)
+    return filenames, None
+
+def delete_upload_sessions(upload_ids):
+    if upload_ids:
+        UploadSession.query.filter(UploadSession.id.in_(upload_ids)).delete(synchronize_session=False)
+
+@app.route('/api/uploads', methods=['POST'])
+def api_create_upload():
+    user = get_request_user()
+    if not user: return jsonify({'error': 'Auth required'}), 401
+
+    data = request.json or {}
+    filename = data.get('filename')
+    size = data.get('size')
+    if not filename or not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'filename and size are required'}), 400
+    if size > app.config['UPLOAD_MAX_SIZE']:
+        return jsonify({'error': f"File exceeds {app.config['UPLOAD_MAX_SIZE']} bytes"}), 413
+
+    cleanup_stale_uploads()
+    upload = UploadSession(user_id=user.id, filename=filename, total_size=size, sha256=data.get('sha256'))
+    db.session.add(upload)
+    db.session.flush()
+    open(upload.partial_path(), 'wb').close()
+    db.session.commit()
+    return jsonify(dict(upload.to_dict(), status='success')), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def api_upload_action(upload_id):
+    user = get_request_user()
+    if not user: return jsonify({'error': 'Auth required'}), 401
+
+    upload = UploadSession.query.get(upload_id)
+    if not upload or upload.user_id != user.id: return jsonify({'error': 'Upload not found'}), 404
+
+    if request.method == 'GET':
+        return jsonify(dict(upload.to_dict(), status='success'))
+
+    if request.method == 'DELETE':
+        discard_upload(upload)
+        db.session.commit()
+        return jsonify({'status': 'success', 'message': 'Upload cancelled'})
+
+    # PUT: 追加一块
+    if upload.completed:
+        return jsonify(dict(upload.to_dict(), status='success'))
+    offset = request.args.get('offset', type=int)
+    chunk = request.get_data(cache=False)
+    if offset is None: return jsonify({'error': 'offset is required'}), 400
+    if offset != upload.received:
+        # 偏移不一致 (重复发送或漏发)，告诉客户端应该从哪里继续
+        return jsonify(dict(upload.to_dict(), error='Offset mismatch')), 409
+    if not chunk or len(chunk) > app.config['UPLOAD_CHUNK_SIZE']:
+        return jsonify({'error': f"Chunk must be 1..{app.config['UPLOAD_CHUNK_SIZE']} bytes"}), 400
+    if offset + len(chunk) > upload.total_size:
+        return jsonify({'error': 'Chunk exceeds declared size'}), 400
+
+    with open(upload.partial_path(), 'r+b') as f:
+        f.seek(offset)
+        f.write(chunk)
+    hasher = update_upload_hash(upload, offset, chunk)
+
+    # 条件更新：并发重试同一块时只有一个请求推进 received
+    advanced = UploadSession.query.filter_by(id=upload.id, received=offset).update({'received': offset + len(chunk), 'updated_at': datetime.now()})
+    db.session.commit()
+    if not advanced:
+        db.session.refresh(upload)
+        return jsonify(dict(upload.to_dict(), error='Offset mismatch')), 409
+    remember_upload_hash(upload, offset + len(chunk), hasher)
+    db.session.refresh(upload)
+
+    if upload.received == upload.total_size:
+        digest, ok = finalize_upload(upload, hasher)
+        db.session.commit()
+        if not ok:
+            return jsonify(dict(upload.to_dict(), error='Checksum mismatch', sha256=digest)), 422
+        return jsonify(dict(upload.to_dict(), status='success', sha256=digest))
+    return jsonify(dict(upload.to_dict(), status='success'))
+
 # ==========================================
 # 新增功能：用户设置 (修改密码 & 注销账号)
 # ==========================================
@@ -958,12 +2562,18 @@ def delete_account():
     try:
         # 1. 删除该用户的所有任务 (级联删除会自动删除笔记 Note)
         tasks = Task.query.filter_by(user_id=current_user.id).all()
+        tasks += ArchivedTask.query.filter_by(user_id=current_user.id).all()
         for task in tasks:
             db.session.delete(task)
+        for upload in UploadSession.query.filter_by(user_id=current_user.id).all():
+            discard_upload(upload)
         
         # 2. 删除用户自身
+        user_id = current_user.id
         db.session.delete(current_user)
         db.session.commit()
+        # 分库模式下连同该用户的数据库文件一起删除
+        if app.config['PARTITION_BY_USER']: PARTITIONS.drop(user_id)
         
         logout_user()
         flash('账号及所有数据已永久删除')
@@ -975,15 +2585,267 @@ def delete_account():
         flash('注销账号时发生错误，请查看日志')
         return redirect(url_for('dashboard'))
 
+# ==========================================
+# 在线备份：不停服备份数据库与上传目录
+# ==========================================
+# 备份目录结构：
+#   BACKUP_DIR/db/todo-YYYYmmdd-HHMMSS.db   数据库快照，保留最近 BACKUP_KEEP 份
+#   BACKUP_DIR/db/archive-YYYYmmdd-HHMMSS.db  冷库快照
+#   BACKUP_DIR/db/user<id>-todo-YYYYmmdd-HHMMSS.db  分库模式下各用户的数据库 (及 -archive- 冷库)
+#   BACKUP_DIR/uploads/                      上传目录的镜像，只复制新增/变化的文件
+#   BACKUP_DIR/manifest.json                 上次备份时各文件的 (大小, mtime)
+#   BACKUP_DIR/last_backup.json              最近一次备份的报告
+# 数据库用 SQLite 在线备份 API 按页分步复制，每步之间释放锁，写请求最多等一步。
+
+def backup_database(db_path, dest_path, archive=None):
+    """
+    按 BACKUP_PAGES_PER_STEP 分步复制数据库，返回写入的字节数。
+    archive 为 (冷库路径, 目标路径) 时冷热两个库从同一个读事务复制：读快照在
+    搬迁锁下一起打开，之后的搬迁不影响快照，也不会被备份挡住。
+    """
+    src = sqlite3.connect(db_path, timeout=app.config['SQLITE_BUSY_TIMEOUT'], isolation_level=None)
+    copies = [('main', dest_path)]
+    try:
+        if archive:
+            src.execute("ATTACH DATABASE ? AS archive", (archive[0],))
+            copies.append(('archive', archive[1]))
+            with archive_move_lock(exclusive=True):
+                src.execute("BEGIN")
+                for schema, _ in copies:
+                    src.execute(f"SELECT count(*) FROM {schema}.sqlite_master").fetchone()
+        written = 0
+        for schema, path in copies:
+            tmp_path = path + '.tmp'
+            dst = sqlite3.connect(tmp_path)
+            try:
+                src.backup(dst, pages=app.config['BACKUP_PAGES_PER_STEP'], name=schema,
+                           sleep=app.config['BACKUP_STEP_SLEEP'])
+            finally:
+                dst.close()
+            os.replace(tmp_path, path)
+            written += os.path.getsize(path)
+        return written
+    finally:
+        src.close()
+
+def scan_uploads():
+    """{相对路径: [大小, mtime_ns]}，跳过续传临时文件和原子写入的临时文件"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    files = {}
+    for entry in os.scandir(upload_folder):
+        if not entry.is_file() or entry.name.startswith('.'): continue
+        st = entry.stat()
+        files[entry.name] = [st.st_size, st.st_mtime_ns]
+    return files
+
+def backup_uploads(dest_dir, manifest):
+    """只复制与 manifest 记录不一致的文件，返回 (新 manifest, 复制文件数, 写入字节数)"""
+    os.makedirs(dest_dir, exist_ok=True)
+    current = scan_uploads()
+    copied = written = 0
+    for name, stat in current.items():
+        if manifest.get(name) == stat and os.path.exists(os.path.join(dest_dir, name)):
+            continue
+        src_path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        with open(src_path, 'rb') as src:
+            atomic_write(os.path.join(dest_dir, name), lambda f: shutil.copyfileobj(src, f))
+        copied += 1
+        written += stat[0]
+    return current, copied, written
+
+def prune_db_backups(db_dir):
+    # 按文件名去掉 "-YYYYmmdd-HHMMSS.db" 后的前缀分组，每组各保留 BACKUP_KEEP 份
+    groups = {}
+    for name in sorted(f for f in os.listdir(db_dir) if f.endswith('.db')):
+        groups.setdefault(name.rsplit('-', 2)[0], []).append(name)
+    for snapshots in groups.values():
+        for name in snapshots[:-app.config['BACKUP_KEEP']] if app.config['BACKUP_KEEP'] > 0 else []:
+            os.remove(os.path.join(db_dir, name))
+
+def run_backup():
+    """
+    执行一次完整备份并返回报告。用文件锁保证同一时刻只有一个备份在跑
+    (定时任务、命令行和多进程之间都适用)，已有备份在跑时返回 None。
+    """
+    backup_dir = app.config['BACKUP_DIR']
+    db_dir = os.path.join(backup_dir, 'db')
+    os.makedirs(db_dir, exist_ok=True)
+    lock = open(os.path.join(backup_dir, '.lock'), 'w')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("已有备份正在进行，跳过本次。")
+            return None
+
+        started_at = datetime.now()
+        started = time.monotonic()
+        stamp = started_at.strftime('%Y%m%d-%H%M%S')
+        db_file = f"todo-{stamp}.db"
+        archive_path = app.config['ARCHIVE_DB_PATH']
+        db_bytes = backup_database(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''), os.path.join(db_dir, db_file),
+                                   (archive_path, os.path.join(db_dir, f"archive-{stamp}.db")) if os.path.exists(archive_path) else None)
+        for user_id in partition_user_ids():
+            todo_path, archive_path = partition_paths(user_id)
+            if not os.path.exists(todo_path): continue
+            db_bytes += backup_database(todo_path, os.path.join(db_dir, f"user{user_id}-todo-{stamp}.db"),
+                                        (archive_path, os.path.join(db_dir, f"user{user_id}-archive-{stamp}.db")) if os.path.exists(archive_path) else None)
+        db_seconds = time.monotonic() - started
+
+        manifest_path = os.path.join(backup_dir, 'manifest.json')
+        try:
+            with open(manifest_path) as f: manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest, copied, upload_bytes = backup_uploads(os.path.join(backup_dir, 'uploads'), manifest)
+        atomic_write(manifest_path, lambda f: f.write(json.dumps(manifest).encode('utf-8')))
+        prune_db_backups(db_dir)
+
+        report = {
+            'started_at': started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_seconds': round(time.monotonic() - started, 3),
+            'db_file': db_file,
+            'db_bytes': db_bytes,
+            'db_seconds': round(db_seconds, 3),
+            'uploads_total': len(manifest),
+            'uploads_copied': copied,
+            'uploads_bytes': upload_bytes,
+            'bytes_written': db_bytes + upload_bytes
+        }
+        atomic_write(os.path.join(backup_dir, 'last_backup.json'),
+                     lambda f: f.write(json.dumps(report, ensure_ascii=False, indent=2).encode('utf-8')))
+        print(f"💾 备份完成：用时 {report['duration_seconds']}s，数据库 {db_bytes} 字节，"
+              f"新增/变化图片 {copied} 个 ({upload_bytes} 字节)，共写入 {report['bytes_written']} 字节")
+        return report
+    finally:
+        lock.close()
+
+def start_periodic(name, hours, job):
+    """hours > 0 时在后台线程里每隔 hours 小时执行一次 job (在 app context 中)"""
+    interval = hours * 3600
+    if interval <= 0: return False
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    job()
+            except Exception as e:
+                print(f"🚨 定时任务 {name} 失败: {e}")
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    return True
+
+def start_backup_scheduler():
+    """BACKUP_INTERVAL_HOURS > 0 时在后台线程定时备份"""
+    if start_periodic('backup-scheduler', app.config['BACKUP_INTERVAL_HOURS'], run_backup):
+        print(f"💾 已启用定时备份：每 {app.config['BACKUP_INTERVAL_HOURS']} 小时一次 -> {app.config['BACKUP_DIR']}")
+
+# ==========================================
+# 多进程部署：多个 waitress 进程共享同一个监听端口
+# ==========================================
+
+@app.errorhandler(OperationalError)
+def handle_db_locked(e):
+    """busy_timeout 内仍拿不到写锁时，让客户端稍后重试而不是直接 500"""
+    db.session.rollback()
+    if 'database is locked' not in str(e.orig): raise e
+    response = jsonify({'error': 'Database busy, please retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['LANE_RETRY_AFTER'])
+    return response
+
+def serve_multiprocess(workers, threads, port):
+    """
+    主进程绑定端口后 fork 出 workers 个子进程，每个子进程跑一个 waitress，
+    由内核在进程间分发连接。子进程意外退出会被重新拉起。
+    注意：通道限流 (LANES) 是按进程计算的。
+    """
+    from waitress import serve
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.listen(1024)
+
+    # 迁移阶段打开过的连接不能带进子进程
+    with app.app_context():
+        db.engine.dispose()
+    PARTITIONS.dispose_all()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # 主进程里的归档清理、定时备份线程会一直往连接池里放连接，之后拉起的
+            # worker 会继承这些连接；子进程只丢掉池子另开新连接，不关闭父进程的连接
+            with app.app_context():
+                db.engine.dispose(close=False)
+            PARTITIONS.reset_after_fork()
+            try:
+                serve(app, sockets=[sock], threads=threads)
+            finally:
+                os._exit(0)
+        return pid
+
+    children = {spawn() for _ in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try: os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"🚀 多进程模式：{workers} 个 worker × {threads} 线程，端口 {port}")
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"⚠️ worker {pid} 意外退出，重新拉起")
+            children.add(spawn())
+
 if __name__ == '__main__':
     with app.app_context():
-        # --- 启动时执行迁移 ---
-        # 1. 检查并迁移数据到 UUID 结构
-        migrate_to_uuid_if_needed(app.app_context()) 
-        # 2. 如果是新数据库，或迁移成功，确保调用 create_all 保证表结构完整
-        db.create_all()
+        # --- 启动时执行迁移 (结构已是最新时直接跳过) ---
+        run_migrations()
+        ensure_archive_schema()
+        if app.config['PARTITION_BY_USER']:
+            migrate_partitions()
+            split_into_partitions()
+        elif partition_user_ids():
+            print(f"⚠️ {app.config['PARTITION_DIR']} 下有分库数据，但未开启 PARTITION_BY_USER，这些数据不会显示")
+
+        # 命令行备份：python app.py backup
+        if sys.argv[1:2] == ['backup']:
+            sys.exit(0 if run_backup() else 1)
+        # 命令行冷库搬迁：python app.py archive-sweep
+        if sys.argv[1:2] == ['archive-sweep']:
+            sweep_cold_archive()
+            sys.exit(0)
+        sweep_cold_archive()
+
+    # 定时任务线程在主进程里跑，多进程模式下也只有一份
+    start_backup_scheduler()
+    if app.config['ARCHIVE_COLD_AFTER_DAYS'] > 0:
+        start_periodic('archive-sweeper', app.config['ARCHIVE_SWEEP_INTERVAL_HOURS'], sweep_cold_archive)
     
     from waitress import serve
-    # 先用最保守的参数，排除配置错误
-    print("🚀 UUID 离线同步架构版启动 (调试模式)...")
-    serve(app, host='0.0.0.0', port=5000, threads=8)
\ No newline at end of file
+    threads = app.config['WAITRESS_THREADS']
+    heavy = sum((lane.limit or 0) + lane.max_queue for lane in LANES.values())
+    if heavy >= threads:
+        print(f"⚠️ 重通道最多可占用 {heavy} 个线程，已不少于总线程数 {threads}，交互请求可能被饿死")
+    if app.config['WORKERS'] > 1:
+        serve_multiprocess(app.config['WORKERS'], threads, app.config['PORT'])
+    else:
+        print("🚀 UUID 离线同步架构版启动 (调试模式)...")
+        serve(app, host='0.0.0.0', port=app.config['PORT'], threads=threads)
\ No newline at end of file
@@ -0,0 +1,313 @@
+"""
+NAS To-Do 基准测试脚本
+
+用法：
+    python bench.py payload [--tasks 50] [--notes 3] [--images 2]
+    python bench.py images [--megapixels 12 48] [--repeat 3]
+    python bench.py workers [--workers 1 2 4] [--clients 16] [--duration 10]
+    python bench.py rows [--tasks 2000] [--notes 3] [--repeat 5]
+
+所有数据写在临时目录里 (通过 DATA_DIR 指向)，不会碰 /data。
+"""
+import os
+import sys
+import json
+import base64
+import shutil
+import argparse
+import tempfile
+import time
+import socket
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+DATA_DIR = tempfile.mkdtemp(prefix='nastodo_bench_')
+os.environ['DATA_DIR'] = DATA_DIR
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+import app as todo
+
+AUTH = {'Authorization': 'Basic ' + base64.b64encode(b'bench:bench').decode()}
+
+
+def make_photo(path, size=(1600, 1200)):
+    """生成一张带噪声的 JPEG，压缩特性接近真实照片"""
+    img = Image.effect_noise(size, 64).convert('RGB')
+    img.save(path, 'JPEG', quality=85)
+
+
+def seed(tasks, notes, images):
+    """建库并灌入测试数据"""
+    with todo.app.app_context():
+        todo.db.create_all()
+        user = todo.User(username='bench', password=generate_password_hash('bench', method='scrypt'))
+        todo.db.session.add(user)
+        todo.db.session.commit()
+        upload_folder = todo.app.config['UPLOAD_FOLDER']
+        for i in range(tasks):
+            task = todo.Task(title=f'任务 {i}', category=f'分类 {i % 5}', content='基准测试内容 ' * 20, user_id=user.id)
+            todo.db.session.add(task)
+            todo.db.session.flush()
+            for j in range(notes):
+                names = []
+                for k in range(images):
+                    name = f'bench_{i}_{j}_{k}.jpg'
+                    path = os.path.join(upload_folder, name)
+                    make_photo(path)
+                    todo.create_thumbnail(path)
+                    names.append(name)
+                todo.db.session.add(todo.Note(content=f'笔记 {j} ' * 30, images=json.dumps(names), task_id=task.id))
+        todo.db.session.commit()
+
+
+def bench_payload(args):
+    seed(args.tasks, args.notes, args.images)
+    client = todo.app.test_client()
+    variants = [
+        ('json', 'application/json', 'identity'),
+        ('json+gzip', 'application/json', 'gzip'),
+        ('json+zstd', 'application/json', 'zstd'),
+        ('msgpack', 'application/x-msgpack', 'identity'),
+        ('msgpack+gzip', 'application/x-msgpack', 'gzip'),
+        ('msgpack+zstd', 'application/x-msgpack', 'zstd'),
+    ]
+    baseline = None
+    print(f"{'format':<14}{'bytes':>12}{'saving':>10}  content-type / encoding")
+    for name, accept, encoding in variants:
+        headers = dict(AUTH, **{'Accept': accept, 'Accept-Encoding': encoding})
+        r = client.get('/api/tasks', headers=headers)
+        size = len(r.data)
+        if baseline is None: baseline = size
+        saving = (1 - size / baseline) * 100
+        print(f"{name:<14}{size:>12}{saving:>9.1f}%  {r.mimetype} / {r.headers.get('Content-Encoding', 'identity')}")
+
+
+def legacy_thumbnail(path, out):
+    """旧版 create_thumbnail 的处理流程"""
+    with Image.open(path) as img:
+        if img.mode in ('RGBA', 'P'): img = img.convert('RGB')
+        img.thumbnail((300, 300))
+        img.save(out, "JPEG", quality=70)
+
+
+def legacy_resize(path, width):
+    """旧版 serve_image 的处理流程：全尺寸解码后再 resize"""
+    with Image.open(path) as img:
+        height = int(img.size[1] * width / img.size[0])
+        img = img.resize((width, height), Image.Resampling.LANCZOS)
+        img.save(BytesIO(), format='JPEG', quality=85, optimize=True)
+
+
+def engine_resize(path, width):
+    w, h = todo.oriented_size(path)
+    target = (width, int(h * width / w))
+    img = todo.decode_image(path, target)
+    try:
+        img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0).save(BytesIO(), format='JPEG', quality=85, optimize=True)
+    finally:
+        img.close()
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def bench_images(args):
+    upload_folder = os.path.join(DATA_DIR, 'uploads')
+    print(f"{'case':<34}{'legacy ms':>12}{'engine ms':>12}{'speedup':>10}")
+    for mp in args.megapixels:
+        w = int((mp * 1_000_000 * 4 / 3) ** 0.5)
+        h = int(w * 3 / 4)
+        path = os.path.join(upload_folder, f'photo_{mp}mp.jpg')
+        # 带 EXIF 旋转标记，模拟竖拍的手机照片
+        exif = Image.Exif()
+        exif[todo.EXIF_ORIENTATION] = 6
+        Image.effect_noise((w, h), 64).convert('RGB').save(path, 'JPEG', quality=90, exif=exif)
+
+        def engine_thumbnail():
+            for suffix, _, _ in todo.app.config['IMAGE_DERIVATIVES']:
+                derived = path.rsplit('.', 1)[0] + suffix
+                if os.path.exists(derived): os.remove(derived)
+            todo.create_thumbnail(path)
+
+        def legacy_multi():
+            legacy_thumbnail(path, os.path.join(upload_folder, 'legacy_thumb.jpg'))
+            legacy_resize(path, 1280)
+
+        def engine_multi():
+            for img in todo.derive_images(path, [(300, 300), (1280, 1280)]): img.close()
+
+        cases = [
+            ('thumbnail 300px', lambda: legacy_thumbnail(path, os.path.join(upload_folder, 'legacy_thumb.jpg')), engine_thumbnail),
+            ('serve_image width=1280', lambda: legacy_resize(path, 1280), lambda: engine_resize(path, 1280)),
+            ('300px + 1280px', legacy_multi, engine_multi),
+        ]
+        for name, legacy, engine in cases:
+            t_legacy = timed(legacy, args.repeat)
+            t_engine = timed(engine, args.repeat)
+            print(f"{f'{mp}MP {name}':<34}{t_legacy:>12.1f}{t_engine:>12.1f}{t_legacy / t_engine:>9.1f}x")
+
+        with Image.open(os.path.join(upload_folder, f'photo_{mp}mp_thumb.jpg')) as thumb:
+            print(f"{'':<34}engine thumbnail {thumb.size[0]}x{thumb.size[1]} (EXIF 旋正后为竖图)")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1): return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'服务器未在 {timeout}s 内启动')
+
+
+def load(port, urls, clients, duration):
+    """clients 个并发客户端轮流请求 urls，返回 (成功数, 失败数)"""
+    deadline = time.time() + duration
+
+    def client(i):
+        ok = failed = 0
+        n = i
+        while time.time() < deadline:
+            req = urllib.request.Request(f'http://127.0.0.1:{port}{urls[n % len(urls)]}', headers=AUTH)
+            n += 1
+            try:
+                with urllib.request.urlopen(req, timeout=60) as r:
+                    r.read()
+                ok += 1
+            except Exception:
+                failed += 1
+        return ok, failed
+
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(client, range(clients)))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def bench_workers(args):
+    seed(args.tasks, 1, 1)
+    upload_folder = todo.app.config['UPLOAD_FOLDER']
+    photos = sorted(f for f in os.listdir(upload_folder) if not f.endswith('_thumb.jpg'))
+    # CPU 密集 (Pillow 缩放) 与 JSON 序列化混合
+    urls = [f'/image/{p}?width={640 + i % 5 * 64}' for i, p in enumerate(photos)] + ['/api/tasks']
+    print(f"CPU 核数: {os.cpu_count()}")
+    print(f"{'workers':>8}{'requests':>10}{'errors':>8}{'req/s':>10}{'scaling':>9}")
+    base = None
+    for workers in args.workers:
+        port = free_port()
+        env = dict(os.environ, DATA_DIR=DATA_DIR, WORKERS=str(workers), PORT=str(port),
+                   WAITRESS_THREADS=str(args.clients), LANE_LIMITS=f'image={args.clients}:{args.clients}:60')
+        proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')],
+                                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            ok, failed = load(port, urls, args.clients, args.duration)
+        finally:
+            proc.terminate()
+            proc.wait()
+        rps = ok / args.duration
+        base = base or rps
+        print(f"{workers:>8}{ok:>10}{failed:>8}{rps:>10.1f}{rps / base:>8.2f}x")
+
+
+def legacy_task_dicts(user_id):
+    """旧版 api_get_tasks 的 ORM 路径"""
+    query = todo.Task.query.filter_by(user_id=user_id).filter((todo.Task.is_archived == False) | (todo.Task.is_archived == None))
+    tasks = query.order_by(*todo.task_order_by(todo.Task, todo.API_DEFAULT_SORT)).all()
+    data = []
+    for t in tasks:
+        item = t.to_dict()
+        item['notes'] = []
+        for n in t.notes:
+            note_dict = n.to_dict()
+            note_dict['images_info'] = todo.build_images_info(n.get_images())
+            item['notes'].append(note_dict)
+        data.append(item)
+    return data
+
+
+def bench_rows(args):
+    seed(args.tasks, args.notes, 0)
+    with todo.app.test_request_context():
+        user_id = todo.User.query.filter_by(username='bench').first().id
+
+        # 每轮换新 session，和真实请求一样没有 identity map 缓存
+        def legacy_build():
+            todo.db.session.remove()
+            return legacy_task_dicts(user_id)
+
+        def fast_build():
+            todo.db.session.remove()
+            return todo.list_task_dicts(user_id)
+
+        payload = {'status': 'success', 'data': fast_build()}
+        assert legacy_build() == payload['data'], '快速路径输出与 ORM 路径不一致'
+        fast_dumps = todo.orjson.dumps if todo.orjson else todo.app.json.dumps
+        rows = args.tasks * (1 + args.notes)
+        cases = [
+            ('build', legacy_build, fast_build),
+            ('encode', lambda: todo.app.json.dumps(payload), lambda: fast_dumps(payload)),
+            ('build + encode', lambda: todo.app.json.dumps({'data': legacy_build()}), lambda: fast_dumps({'data': fast_build()})),
+        ]
+        print(f"{args.tasks} 个任务 x {args.notes} 条笔记 = {rows} 行，JSON 编码器: {'orjson' if todo.orjson else 'flask json'}")
+        print(f"{'stage':<18}{'ORM ms':>10}{'fast ms':>10}{'ORM us/row':>12}{'fast us/row':>13}{'speedup':>9}")
+        for name, legacy, fast in cases:
+            t_legacy = timed(legacy, args.repeat)
+            t_fast = timed(fast, args.repeat)
+            print(f"{name:<18}{t_legacy:>10.1f}{t_fast:>10.1f}{t_legacy * 1000 / rows:>12.2f}"
+                  f"{t_fast * 1000 / rows:>13.2f}{t_legacy / t_fast:>8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NAS To-Do 基准测试')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('payload', help='比较 /api/tasks 各种传输格式与压缩的体积')
+    p.add_argument('--tasks', type=int, default=50)
+    p.add_argument('--notes', type=int, default=3)
+    p.add_argument('--images', type=int, default=2)
+    p.set_defaults(func=bench_payload)
+
+    p = sub.add_parser('images', help='比较旧版与图片引擎的解码/缩放耗时')
+    p.add_argument('--megapixels', type=int, nargs='+', default=[12, 48])
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_images)
+
+    p = sub.add_parser('workers', help='多进程模式吞吐随 worker 数的变化')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--clients', type=int, default=16)
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--tasks', type=int, default=20)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser('rows', help='比较 /api/tasks 的 ORM 路径与快速读路径的每行开销')
+    p.add_argument('--tasks', type=int, default=2000)
+    p.add_argument('--notes', type=int, default=3)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_rows)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    finally:
+        shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())